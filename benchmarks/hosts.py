@@ -0,0 +1,44 @@
+#!/usr/bin/python3 -u
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmark of subnet enumeration used to probe addresses of virtual
+# machines: time to the first probe batch, time of full walk and peak
+# memory for /24, /20 and /16 networks.
+#
+# Run from repository root: python3 benchmarks/hosts.py
+#
+
+import os
+import sys
+import time
+import itertools
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import virtup  # noqa: E402
+
+
+def measure(cidr):
+    tracemalloc.start()
+    start = time.perf_counter()
+    hosts = virtup.Net.hosts([cidr])
+    batch = list(itertools.islice(hosts, virtup.PROBE_BATCH))
+    first = time.perf_counter() - start
+    count = len(batch)
+    while batch:
+        batch = list(itertools.islice(hosts, virtup.PROBE_BATCH))
+        count += len(batch)
+    total = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return count, first, total, peak
+
+
+if __name__ == '__main__':
+    print('{0:<8}{1:>10}{2:>15}{3:>15}{4:>10}'.format('Prefix', 'Hosts',
+            'First batch', 'Full walk', 'Peak'))
+    for cidr in ('10.0.0.1/24', '10.0.0.1/20', '10.0.0.1/16'):
+        count, first, total, peak = measure(cidr)
+        print('{0:<8}{1:>10}{2:>13.1f}ms{3:>13.1f}ms{4:>8}KB'.format(
+                cidr[cidr.index('/'):], count, first * 1000, total * 1000,
+                peak // 1024))
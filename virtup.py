@@ -15,35 +15,166 @@
 #
 
 import os
-import re
 import sys
+import json
+import socket
+
+# Directory for checkpoints of interrupted volume transfers and template
+# cache state
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME',
+        os.path.expanduser('~/.cache')), 'virtup')
+# Unix socket daemon serves commands on
+DAEMON_SOCKET = os.environ.get('VIRTUP_SOCKET', os.path.join(
+        os.environ.get('XDG_RUNTIME_DIR', CACHE_DIR), 'virtup.sock'))
+
+
+# Send command line to running daemon, output of command is passed through
+# as it comes. Return exit code of command or None if daemon is not running
+# or leaves command to be run locally
+def forward(argv, path=DAEMON_SOCKET):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    with sock:
+        sock.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode() + b'\n')
+        for line in sock.makefile('rb'):
+            msg = json.loads(line)
+            if 'local' in msg:
+                return None
+            if 'code' in msg:
+                return msg['code']
+            out = sys.stdout if msg['fd'] == 1 else sys.stderr
+            out.write(msg['data'])
+            out.flush()
+    print('Daemon closed connection')
+    return 1
+
+
+# Command is served by daemon if it is running, before the rest of virtup
+# and libvirt are loaded
+if __name__ == '__main__' and len(sys.argv) > 1 and '--local' not in sys.argv:
+    code = forward(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+
+import re
+import errno
 import tty
 import random
 import termios
+import fcntl
 import atexit
 import libvirt
 import argparse
 import xml.dom.minidom  # for pretty printing
-from multiprocessing import Pool
+import time
+import gzip
+import zlib
+import lzma
+import queue
+import struct
+import hashlib
+import threading
+import asyncio
+import ipaddress
+import uuid
+import itertools
+import shlex
+import contextlib
+import io
+import socketserver
+import signal
 from xml.etree import ElementTree as ET
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Default size of block read from file or stream during volume transfer
+CHUNK_SIZE = 262144
+# Biggest transfer block, keeps stream messages well below libvirt RPC limit
+CHUNK_MAX = 16 * 1024 * 1024
+# Bytes of image read to probe its format
+PROBE_HEAD = 65536
+# Block of image data digested on its own for manifest, digest of zero block
+# is computed once so holes cost nothing
+DIGEST_BLOCK = 1024 * 1024
+# Identifiers of vhdx metadata region and its items
+VHDX_METADATA = uuid.UUID('8b7ca206-4790-4b9a-b8fe-575f050f886e').bytes_le
+VHDX_FILE_PARAMS = uuid.UUID('caa16737-fa36-4d43-b3b6-33f0aa44e76b').bytes_le
+VHDX_DISK_SIZE = uuid.UUID('2fa54224-cd1b-4876-b211-5dbed83bf4b8').bytes_le
+# Amount of blocks buffered between reading and sending sides of transfer
+QUEUE_DEPTH = 16
+# Hash algorithms for image digests
+DIGESTS = ['blake2b', 'blake2s', 'sha256', 'sha512', 'sha1', 'md5']
+if xxhash is not None:
+    DIGESTS = ['xxh3_128', 'xxh3_64', 'xxh64'] + DIGESTS
+# Seconds given to ip address lookup of virtual machine
+IP_TIMEOUT = 10
+# Namespace of virtup elements in domain metadata
+META_NS = 'https://github.com/kshcherban/virtup'
+# Amount of domains resolved concurrently by ls -ip
+IP_CONCURRENCY = 16
+# Amount of hosts probed at once and seconds to wait for their arp replies
+PROBE_BATCH = 256
+PROBE_WAIT = 0.2
+# Seconds up wait gives up after by default
+WAIT_TIMEOUT = 300
+# Longest pause between checks of booting machines while no event comes
+WAIT_BACKOFF = 5
+# Storage pool types whose volumes are thin, so freed blocks are given back
+THIN_POOLS = ('dir', 'fs', 'netfs', 'rbd', 'gluster')
+# Disks of guest from which auto disk tuning switches to virtio-scsi
+SCSI_DISKS = 4
+# Ring sizes of virtio-net queues and vhost offloads libvirt can set
+NET_RINGS = (256, 512, 1024)
+NET_OFFLOADS = {
+    'host': ('csum', 'gso', 'tso4', 'tso6', 'ecn', 'ufo', 'mrg_rxbuf'),
+    'guest': ('csum', 'tso4', 'tso6', 'ecn', 'ufo'),
+}
+# Digests of image files and last use times of cached template volumes
+HASH_DB = os.path.join(CACHE_DIR, 'digests.json')
+LRU_DB = os.path.join(CACHE_DIR, 'cache.json')
+# Seconds looked up domains, pools and volumes are remembered for, and for
+# domains and pools whose lifecycle events are watched. Events do not come
+# for every change, such as device hotplug or edits of configuration
+INVENTORY_TTL = 5
+INVENTORY_EVENT_TTL = 60
+# Commands daemon leaves to client: interactive, local file transfers and
+# long waits would hold up commands queued behind them
+LOCAL_COMMANDS = ('console', 'daemon', 'help', 'import', 'export', 'template',
+                  'suspend', 'resume')
 
 
 class Disk:
     """Contains disk based procedures, provides methods to create, delete,
     download, upload volumes.
-    Takes storage pool name and libvirt connection object as arguments
+    Takes storage pool name and libvirt connection object as arguments,
+    optionally size of block used for volume transfers
     """
-    def __init__(self, conn, pool):
+    def __init__(self, conn, pool, chunk=CHUNK_SIZE):
         self.conn = conn
         self.pool = pool
+        self.chunk = min(chunk, CHUNK_MAX)
 
-    def vol_tmpl(self, imgtype, name, capacity, path):
-        """Generate volume template based on disk type"""
+    def vol_tmpl(self, imgtype, name, capacity, path, backing=None,
+            allocation=None):
+        """Generate volume template based on disk type. Backing is
+        (path, format) of volume new one is overlay of, capacity can be None
+        then and is taken from backing volume"""
         tmpl_root = ET.Element('volume')
         tmpl_name = ET.SubElement(tmpl_root, 'name')
         tmpl_name.text = name
-        tmpl_cap = ET.SubElement(tmpl_root, 'capacity')
-        tmpl_cap.text = str(capacity)
+        if capacity is not None:
+            tmpl_cap = ET.SubElement(tmpl_root, 'capacity')
+            tmpl_cap.text = str(capacity)
         tmpl_target = ET.SubElement(tmpl_root, 'target')
         tmpl_target_path = ET.SubElement(tmpl_target, 'path')
         tmpl_target_path.text = path + '/' + name
@@ -52,9 +183,17 @@ class Disk:
         tmpl_target_perm_mode.text = '0600'
         tmpl_target_format = ET.SubElement(tmpl_target, 'format')
         tmpl_target_format.set('type', imgtype)
-        if imgtype == 'qcow2':
+        if allocation is None and imgtype == 'qcow2':
+            allocation = 536576
+        if allocation is not None:
             tmpl_alloc = ET.SubElement(tmpl_root, 'allocation')
-            tmpl_alloc.text = '536576'
+            tmpl_alloc.text = str(allocation)
+        if backing:
+            tmpl_backing = ET.SubElement(tmpl_root, 'backingStore')
+            tmpl_backing_path = ET.SubElement(tmpl_backing, 'path')
+            tmpl_backing_path.text = backing[0]
+            tmpl_backing_format = ET.SubElement(tmpl_backing, 'format')
+            tmpl_backing_format.set('type', backing[1])
         return ET.tostring(tmpl_root, encoding="unicode")
 
     def vol_obj(self, obj):
@@ -62,81 +201,296 @@ class Disk:
         volume object or name"""
         if not isinstance(obj, str):
             return obj
-        p = self.pool
         try:
-            vol = self.conn.storagePoolLookupByName(p).storageVolLookupByName(obj)
-            return vol
+            return state(self.conn).volume(self.pool, obj)
         except libvirt.libvirtError:
             sys.exit(1)
 
-    def create_vol(self, name, imgsize, imgtype):
+    def create_vol(self, name, imgsize, imgtype, backing=None, allocation=None):
         """Create volume in specified pool with specified name, size, format
-        and pool. Return full path to created volume"""
+        and pool, optionally as overlay of backing (path, format).
+        Return full path to created volume"""
+        st = state(self.conn)
         try:
-            s = self.conn.storagePoolLookupByName(self.pool)
+            s = st.pool(self.pool)
+            xe = st.pool_xml(self.pool)
         except libvirt.libvirtError:
             sys.exit(1)
-        xe = ET.fromstring(s.XMLDesc(0))
         # find storage pool path
         spath = xe.find('.//path').text
-        tmpl = self.vol_tmpl(imgtype, name, imgsize, spath)
+        tmpl = self.vol_tmpl(imgtype, name, imgsize, spath, backing, allocation)
         try:
             v = s.createXML(tmpl, 0)
         except libvirt.libvirtError:
             sys.exit(1)
+        st.drop('volume', self.pool)
         return spath + '/' + name
 
+    def create_image_vol(self, name, info):
+        """Create volume image probed by probe_image is uploaded into.
+        Volume is as large as virtual disk of image, in LVM pools with room
+        for metadata of formats growing with guest writes. In directory pools
+        nothing is preallocated, upload writes only allocated data.
+        Return full path to created volume"""
+        try:
+            lvm = state(self.conn).pool_xml(self.pool).get('type') == 'logical'
+        except libvirt.libvirtError:
+            sys.exit(1)
+        capacity = max(info['virtual_size'], info['apparent'])
+        allocation = 0
+        if lvm:
+            allocation = None
+            if info['format'] != 'raw':
+                capacity = max(capacity, image_max_size(info))
+        return self.create_vol(name, capacity, info['format'],
+                allocation=allocation)
+
+    def create_linked_vol(self, name, base):
+        """Create qcow2 volume backed by template volume of the same pool,
+        only image metadata is written. Return full path to created volume"""
+        base = self.vol_obj(base)
+        fmt = ET.fromstring(base.XMLDesc(0)).find('.//target/format').get('type')
+        return self.create_vol(name, None, 'qcow2', (base.path(), fmt))
+
     def delete_vol(self, vol):
         """Delete volume by name"""
+        st = state(self.conn)
         try:
-            p = self.conn.storagePoolLookupByName(self.pool)
-            p.storageVolLookupByName(vol).delete(0)
+            st.volume(self.pool, vol).delete(0)
         except libvirt.libvirtError:
             sys.exit(1)
+        st.drop('volume', self.pool)
         return 1
 
-    def download_vol(self, vol, src):
-        """Download specified volume by name into specified file"""
+    def find_vol(self, name):
+        """Return volume object by name, None if there is no such volume"""
+        try:
+            return state(self.conn).volume(self.pool, name)
+        except libvirt.libvirtError:
+            return None
+
+    def vol_block_sum(self, vol, ckpt, offset, length):
+        """Return checksum of volume block, reading it back from volume"""
+        stream = self.conn.newStream(0)
+        vol.download(stream, offset, length, 0)
+        h = ckpt.new_hash()
+        while True:
+            data = stream.recv(self.chunk)
+            if not data:
+                break
+            h.update(data)
+        stream.finish()
+        return h.hexdigest()
+
+    def download_vol(self, vol, src, sparse=True, resume=False, algo=None,
+            blockmap=False, since=None):
+        """Download specified volume by name into specified file. In sparse
+        mode volume holes are requested from libvirt and kept as holes in
+        output file instead of being written as zeros. Receiving from stream
+        and writing into file run concurrently, file with compression
+        extension is compressed on the fly in writing thread.
+        Progress of uncompressed download is checkpointed, with resume
+        interrupted download is verified and continued. If hash algorithm is
+        given, digest of volume data is computed on the fly and saved into
+        manifest next to the file.
+        With blockmap block map of volume is saved next to the file. With
+        block map of previous export given as since, only blocks changed
+        since then are written into file as delta export"""
         # Get volume object
         vol = self.vol_obj(vol)
-        # Build stream object
-        stream = self.conn.newStream(0)
         # Get volume size
         size = vol.info()[1]
-        # Register download
+        delta = since is not None
+        compressed = not delta and image_codec(src)
+        # Compressed stream and delta can not be continued from the middle
+        ckpt = None
         offset = 0
-        length = size
+        if not compressed and not delta:
+            ckpt = Checkpoint('download', vol, src, {'capacity': size})
+            if resume and os.path.isfile(src) and ckpt.load():
+                def file_block_sum(start, length):
+                    h = ckpt.new_hash()
+                    with open(src, 'rb') as fb:
+                        fb.seek(start)
+                        h.update(fb.read(length))
+                    return h.hexdigest()
+                offset = ckpt.verify(file_block_sum)
+        digest = None
+        if algo:
+            digest = Digest(algo, DIGEST_BLOCK)
+            # Digest of resumed download starts from data already on disk
+            if offset:
+                with open(src, 'rb') as fd:
+                    digest.update_file(fd, offset)
+        bmap = None
+        if blockmap or delta:
+            bmap = BlockMap(size, since)
+            if offset:
+                with open(src, 'rb') as fd:
+                    bmap.update_file(fd, offset)
+        # Register download
+        length = size - offset
         flags = 0
-        vol.download(stream, offset, length, flags)
+        if sparse:
+            flags = getattr(libvirt, 'VIR_STORAGE_VOL_DOWNLOAD_SPARSE_STREAM', 0)
+        # Build stream object
+        stream = self.conn.newStream(0)
+        try:
+            vol.download(stream, offset, length, flags)
+        except libvirt.libvirtError:
+            if not flags:
+                raise
+            # Older libvirtd rejects sparse flag, retry with plain stream
+            flags = 0
+            stream = self.conn.newStream(0)
+            vol.download(stream, offset, length, flags)
+        recv_flags = 0
+        if flags:
+            recv_flags = libvirt.VIR_STREAM_RECV_STOP_AT_HOLE
+        chunk = self.chunk
+        zero = bytes(chunk)
+
+        def receive():
+            while True:
+                if recv_flags:
+                    data = stream.recvFlags(chunk, recv_flags)
+                else:
+                    data = stream.recv(chunk)
+                if data:
+                    yield 0, data
+                    continue
+                # Either end of stream or a hole in sparse stream
+                hole = recv_flags and stream.recvHole(0)
+                if not hole:
+                    break
+                yield hole, None
+
+        def write(item):
+            hole, data = item
+            if bmap:
+                if hole:
+                    bmap.feed_zeros(hole)
+                else:
+                    bmap.feed(data)
+            if delta:
+                # Block map writes changed blocks into delta file
+                if digest:
+                    if hole:
+                        digest.update_zeros(hole)
+                    else:
+                        digest.update(data)
+                if hole:
+                    progress.update(hole, moved=False)
+                else:
+                    progress.update(len(data))
+                return
+            if hole and compressed:
+                # Compressed stream has no holes, zeros are cheap to compress
+                if digest:
+                    digest.update_zeros(hole)
+                while hole:
+                    n = min(hole, chunk)
+                    f.write(zero[:n])
+                    hole -= n
+                    progress.update(n, moved=False)
+                return
+            if hole:
+                f.seek(hole, os.SEEK_CUR)
+                progress.update(hole, moved=False)
+                ckpt.feed_zeros(hole)
+                if digest:
+                    digest.update_zeros(hole)
+                return
+            # Zero filled blocks are skipped too, to keep file sparse
+            if data == zero[:len(data)] and not compressed:
+                f.seek(len(data), os.SEEK_CUR)
+            else:
+                f.write(data)
+            progress.update(len(data))
+            if ckpt:
+                ckpt.feed(data)
+            if digest:
+                digest.update(data)
         # Open file
-        f = open(src, 'w')
+        if offset:
+            f = open(src, 'r+b')
+            # Drop not verified tail, it is downloaded again
+            f.truncate(offset)
+            f.seek(offset)
+            print('Resuming download of volume {0} from {1}'.format(vol.name(),
+                    convert_bytes(offset)))
+        elif delta:
+            f = open(src, 'wb')
+            bmap.start(f)
+        else:
+            f = open_image(src, 'wb')
         # Start transfer
-        total = 0
         print('Downloading volume {0} into {1}'.format(vol.name(),
                 os.path.abspath(src)))
+        progress = Progress(size, offset=offset)
         try:
-            while True:
-                ret = stream.recv(256000)
-                if not ret:
-                    break
-                f.write(ret)
-                total += len(ret)
-                sys.stderr.write('\rdone {0:.2%}'.format(float(total) / size))
+            pipeline(receive(), write)
+            if bmap:
+                bmap.finish()
+            # Trailing holes are only seeked over, set file length explicitly
+            if not compressed and not delta:
+                f.truncate(progress.total)
             # Cleanup
             stream.finish()
             f.close()
-            print('')
+            progress.finish()
+            if ckpt:
+                ckpt.remove()
+            print('Received {0} of {1}'.format(convert_bytes(progress.moved),
+                    convert_bytes(progress.total - offset)))
+            if compressed:
+                print('Compressed into {0}'.format(
+                        convert_bytes(os.path.getsize(src))))
+            if bmap:
+                bmap.save(src)
+            if delta:
+                print('Changed {0} of {1} blocks, delta is {2}'.format(
+                        bmap.changed, len(bmap.sums),
+                        convert_bytes(os.path.getsize(src))))
+            if digest:
+                digest.save(src)
+                print('{0} {1}'.format(digest.algo, digest.hexdigest()))
             return 1
         except libvirt.libvirtError:
-            os.remove(src)
+            f.close()
             print('Error downloading volume')
+            if ckpt and ckpt.offset():
+                ckpt.save()
+                print('Downloaded {0}, run export again with --resume to '
+                      'continue'.format(convert_bytes(ckpt.offset())))
+            else:
+                os.remove(src)
             return 0
 
-    def upload_vol(self, vol, src):
-        """Upload image into specified volume"""
+    def upload_vol(self, vol, src, sparse=True, size=None, resume=False,
+            algo=None, convert=False, deltas=None, resumable=True):
+        """Upload image into specified volume. In sparse mode holes and zero
+        filled blocks of image are not sent over the stream, falls back to
+        plain upload if libvirt does not support sparse streams. Reading file
+        and sending into stream run concurrently, compressed image is
+        decompressed on the fly. Size of image data is found out unless
+        provided.
+        Progress is checkpointed, with resume interrupted upload is verified
+        and continued. Volume is removed on failure unless something to
+        resume from was uploaded and upload is resumable.
+        Digest of image data is computed on the fly with given hash algorithm
+        or with one from image manifest, uploaded data is verified against
+        manifest if image has it.
+        With convert qcow2 image is uploaded as raw disk of its virtual size,
+        manifest of image file does not apply then. Chain of delta exports
+        is applied over image while it is uploaded, manifest of the last one
+        applies then"""
         vol = self.vol_obj(vol)
-        # Build stream object
-        stream = self.conn.newStream(0)
+
+        def source():
+            if convert:
+                return Qcow2Image(open_source(src, deltas))
+            return open_source(src, deltas)
 
         def safe_send(data):
             while True:
@@ -144,247 +498,2229 @@ class Disk:
                 if ret == 0 or ret == len(data):
                     break
                 data = data[ret:]
+
+        def send(item):
+            hole, data = item
+            if hole:
+                stream.sendHole(hole, 0)
+                progress.update(hole, moved=False)
+                ckpt.feed_zeros(hole)
+                if digest:
+                    digest.update_zeros(hole)
+            else:
+                safe_send(data)
+                progress.update(len(data))
+                ckpt.feed(data)
+                if digest:
+                    digest.update(data)
         # Build placeholder volume
-        size = os.path.getsize(src)
+        if size is None:
+            size = image_size(src)
+        manifest = not convert and Digest.load(deltas[-1] if deltas else src)
+        if manifest:
+            if manifest['size'] != size:
+                print('Image size does not match manifest {0}'.format(
+                        Digest.manifest(src)))
+                if vol:
+                    vol.delete(0)
+                return 0
+            algo = manifest['algorithm']
+            # Manifests without block size digest data as one stream
+            block = manifest.get('block')
+        else:
+            block = DIGEST_BLOCK
+        ident = {'size': size, 'mtime': os.path.getmtime(src)}
+        if deltas:
+            ident['deltas'] = [os.path.abspath(d) for d in deltas]
+        ckpt = Checkpoint('upload', vol, src, ident)
+        offset = 0
+        if resume and ckpt.load():
+            offset = ckpt.verify(
+                lambda start, length: self.vol_block_sum(vol, ckpt, start, length))
+        digest = None
+        if algo:
+            digest = Digest(algo, block)
+            # Digest of resumed upload starts from data uploaded before
+            if offset:
+                with source() as fd:
+                    digest.update_file(fd, offset)
+        flags = 0
+        if sparse:
+            flags = getattr(libvirt, 'VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM', 0)
         try:
             # Register upload
-            offset = 0
-            length = size
-            flags = 0
-            vol.upload(stream, offset, length, flags)
+            length = size - offset
+            stream = self.conn.newStream(0)
+            try:
+                vol.upload(stream, offset, length, flags)
+            except libvirt.libvirtError:
+                if not flags:
+                    raise
+                # Older libvirtd rejects sparse flag, retry with plain stream
+                flags = 0
+                stream = self.conn.newStream(0)
+                vol.upload(stream, offset, length, flags)
             # Open source file
-            fileobj = open(src, "rb")
+            fileobj = source()
+            if hasattr(fileobj, 'extents'):
+                extents = clip_extents(fileobj.extents(), offset)
+            elif image_codec(src):
+                # Holes of compressed image can not be looked up, only zero
+                # filled blocks are skipped
+                extents = [(offset, length, True)]
+            else:
+                extents = clip_extents(file_extents(fileobj, size), offset)
+            if offset:
+                fileobj.seek(offset)
+                print('Resuming upload of volume {0} from {1}'.format(vol.name(),
+                        convert_bytes(offset)))
             # Start transfer
-            total = 0
             print('Uploading volume {0} from {1}'.format(vol.name(),
                     os.path.abspath(src)))
-            while True:
-                blocksize = 256000
-                data = fileobj.read(blocksize)
-                if not data:
-                    break
-                safe_send(data)
-                total += len(data)
-                sys.stderr.write('\rdone {0:.2%}'.format(float(total) / size))
+            progress = Progress(size, offset=offset)
+            pipeline(read_sparse(fileobj, size, self.chunk, bool(flags), extents),
+                    send)
             # Cleanup
             stream.finish()
-            print('')
+            fileobj.close()
+            progress.finish()
+            ckpt.remove()
+            if flags:
+                print('Sent {0} of {1}'.format(convert_bytes(progress.moved),
+                        convert_bytes(length)))
         except Exception as e:
             print(e)
-            if vol:
+            if resumable and ckpt.offset():
+                ckpt.save()
+                print('Uploaded {0}, run import again with --resume to '
+                      'continue'.format(convert_bytes(ckpt.offset())))
+            else:
+                ckpt.remove()
+                if vol:
+                    vol.delete(0)
+            return 0
+        if digest:
+            print('{0} {1}'.format(digest.algo, digest.hexdigest()))
+            if manifest and manifest['digest'] != digest.hexdigest():
+                print('Uploaded data does not match manifest {0}'.format(
+                        Digest.manifest(src)))
                 vol.delete(0)
+                return 0
+        return 1
+
+
+class Checkpoint:
+    """Checkpoint of volume transfer, keeps checksums of fixed size blocks
+    transferred so far. Interrupted transfer can be verified against them and
+    resumed from the end of last intact block.
+    Takes transfer direction, volume object, local file path and dict of
+    values identifying transfer as arguments
+    """
+    block = 64 * 1024 * 1024
+
+    def __init__(self, direction, vol, src, ident):
+        key = '{0}:{1}:{2}'.format(direction, vol.key(), os.path.abspath(src))
+        self.path = os.path.join(CACHE_DIR,
+                hashlib.sha1(key.encode()).hexdigest() + '.json')
+        self.meta = dict(ident, key=key, block=self.block)
+        self.sums = []
+        self.hash = self.new_hash()
+        self.filled = 0
+        self.zero_sum = None
+
+    @staticmethod
+    def new_hash():
+        """Return hash object used for block checksums"""
+        return hashlib.blake2b(digest_size=16)
+
+    def offset(self):
+        """Return amount of bytes covered by checkpoint"""
+        return len(self.sums) * self.block
+
+    def load(self):
+        """Load saved checkpoint, return True if it belongs to this transfer"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if data.get('meta') != self.meta:
+            return False
+        self.sums = data['sums']
+        return True
+
+    def save(self):
+        """Write checkpoint on disk"""
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'meta': self.meta, 'sums': self.sums}, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        """Remove checkpoint of finished transfer"""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def verify(self, block_sum, tries=4):
+        """Check last blocks of checkpoint with block_sum(offset, length)
+        function, drop blocks which do not match. Return offset transfer can
+        be resumed from"""
+        for i in range(tries):
+            if not self.sums:
+                break
+            start = self.offset() - self.block
+            if block_sum(start, self.block) == self.sums[-1]:
+                return self.offset()
+            self.sums.pop()
+        # Too much does not match, start from scratch
+        self.sums = []
+        return 0
+
+    def feed(self, data):
+        """Account transferred data"""
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.block - self.filled)
+            self.hash.update(view[:n])
+            self.filled += n
+            view = view[n:]
+            if self.filled == self.block:
+                self.next_block()
+
+    def feed_zeros(self, length):
+        """Account transferred hole"""
+        while length:
+            if not self.filled and length >= self.block:
+                # Whole block of zeros, checksum is computed only once
+                if self.zero_sum is None:
+                    h = self.new_hash()
+                    h.update(bytes(self.block))
+                    self.zero_sum = h.hexdigest()
+                self.sums.append(self.zero_sum)
+                length -= self.block
+                if length < self.block:
+                    self.save()
+                continue
+            n = min(length, self.block - self.filled)
+            self.feed(bytes(n))
+            length -= n
+
+    def next_block(self):
+        """Store checksum of completed block"""
+        self.sums.append(self.hash.hexdigest())
+        self.hash = self.new_hash()
+        self.filled = 0
+        self.save()
+
+
+class Digest:
+    """Digest of image data computed while it is transferred, holes are
+    accounted as zeros. With block size data is digested block by block and
+    the result is digest of block digests, so whole blocks of holes only
+    reuse digest of zero block. Without it data is digested as one stream,
+    as in manifests written before blocks were introduced. Digest is kept in
+    JSON manifest next to image file.
+    Takes hash algorithm name and optional block size as arguments
+    """
+    zero = bytes(1024 * 1024)
+
+    def __init__(self, algo, block=None):
+        self.algo = algo
+        self.block = block
+        self.hash = self.new_hash()
+        self.size = 0
+        self.part = self.new_hash()
+        self.filled = 0
+        self.zero_sum = None
+
+    def new_hash(self):
+        """Return hash object of digest algorithm"""
+        if self.algo.startswith('xxh'):
+            return getattr(xxhash, self.algo)()
+        return hashlib.new(self.algo)
+
+    def update(self, data):
+        """Account transferred data"""
+        self.size += len(data)
+        if not self.block:
+            self.hash.update(data)
+            return
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.block - self.filled)
+            self.part.update(view[:n])
+            self.filled += n
+            view = view[n:]
+            if self.filled == self.block:
+                self.hash.update(self.part.digest())
+                self.part = self.new_hash()
+                self.filled = 0
+
+    def update_zeros(self, length):
+        """Account transferred hole"""
+        while length:
+            if self.block and not self.filled and length >= self.block:
+                # Whole block of zeros, digest is computed only once
+                if self.zero_sum is None:
+                    h = self.new_hash()
+                    for i in range(0, self.block, len(self.zero)):
+                        h.update(self.zero[:min(len(self.zero), self.block - i)])
+                    self.zero_sum = h.digest()
+                self.hash.update(self.zero_sum)
+                self.size += self.block
+                length -= self.block
+                continue
+            n = min(length, len(self.zero))
+            if self.block:
+                n = min(n, self.block - self.filled)
+            self.update(self.zero[:n])
+            length -= n
+
+    def update_file(self, fileobj, length):
+        """Account data read from beginning of file"""
+        while length:
+            data = fileobj.read(min(length, CHUNK_MAX))
+            if not data:
+                break
+            self.update(data)
+            length -= len(data)
+
+    def hexdigest(self):
+        """Return digest of data accounted so far"""
+        if not self.filled:
+            return self.hash.hexdigest()
+        # Last block is short
+        h = self.hash.copy()
+        h.update(self.part.digest())
+        return h.hexdigest()
+
+    @staticmethod
+    def manifest(src):
+        """Return manifest path of image file"""
+        return src + '.manifest'
+
+    def save(self, src):
+        """Write manifest of image file"""
+        data = {'image': os.path.basename(src), 'algorithm': self.algo,
+                'digest': self.hexdigest(), 'size': self.size}
+        if self.block:
+            data['block'] = self.block
+        with open(self.manifest(src), 'w') as f:
+            json.dump(data, f, indent=1)
+
+    @classmethod
+    def load(cls, src):
+        """Return manifest of image file as dict, None if there is none"""
+        try:
+            with open(cls.manifest(src)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+
+# Serializes changes of JSON state files by parallel provisioning, file
+# lock keeps other processes out
+db_lock = threading.Lock()
+
+
+class Cache:
+    """Content addressed cache of template images kept as volumes of storage
+    pool. Images are keyed by digest of their data, new volumes are cloned
+    from cached ones on hypervisor side instead of being uploaded.
+    Takes libvirt connection object and cache pool name as arguments
+    """
+    prefix = 'virtup-cache-'
+
+    def __init__(self, conn, pool):
+        self.conn = conn
+        self.pool = pool
+
+    @staticmethod
+    def load_db(path):
+        """Read JSON state file, return empty dict if there is none"""
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    @staticmethod
+    def save_db(path, data):
+        """Write JSON state file"""
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Imports running in parallel threads write their own temporary files
+        tmp = '{0}.{1}.tmp'.format(path, threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    @classmethod
+    @contextlib.contextmanager
+    def update_db(cls, path):
+        """Yield data of JSON state file to be changed and write it back,
+        other threads and processes wait for it meanwhile"""
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with db_lock, open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = cls.load_db(path)
+            yield data
+            cls.save_db(path, data)
+
+    def digest(self, image):
+        """Return cache key of image file. Digest of image data is computed
+        once and remembered by file inode, size and modification time"""
+        st = os.stat(image)
+        ident = '{0}:{1}'.format(st.st_dev, st.st_ino)
+        db = self.load_db(HASH_DB)
+        known = db.get(ident)
+        if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime:
+            return known['digest']
+        print('Computing digest of {0}'.format(image))
+        digest = Digest('blake2b')
+        with open_image(image) as f:
+            while True:
+                data = f.read(CHUNK_MAX)
+                if not data:
+                    break
+                digest.update(data)
+        with self.update_db(HASH_DB) as db:
+            db[ident] = {'size': st.st_size, 'mtime': st.st_mtime,
+                         'digest': digest.hexdigest()}
+        return digest.hexdigest()
+
+    def vol_name(self, key):
+        """Return name of cache volume holding image with given key"""
+        return self.prefix + key[:40]
+
+    def touch(self, volname, remove=False):
+        """Remember time cache volume was used, forget it if removed"""
+        ident = '{0} {1} {2}'.format(self.conn.getURI(), self.pool, volname)
+        with self.update_db(LRU_DB) as db:
+            if remove:
+                db.pop(ident, None)
+            else:
+                db[ident] = time.time()
+
+    def volumes(self):
+        """Return list of (volume object, allocation, last use time) of cache
+        volumes, least recently used first"""
+        db = self.load_db(LRU_DB)
+        uri = self.conn.getURI()
+        vols = []
+        for v in self.conn.storagePoolLookupByName(self.pool).listAllVolumes(0):
+            if not v.name().startswith(self.prefix):
+                continue
+            used = db.get('{0} {1} {2}'.format(uri, self.pool, v.name()), 0)
+            vols.append((v, v.info()[2], used))
+        return sorted(vols, key=lambda v: v[2])
+
+    def find(self, key):
+        """Return cache volume of image with given key, None if image is not
+        cached. Cache volume is complete once it exists, it is created from
+        part volume after upload finished"""
+        return Disk(self.conn, self.pool).find_vol(self.vol_name(key))
+
+    def copy(self, src, name, pool, allocation=None):
+        """Create volume with given name in given pool as hypervisor side
+        copy of volume object. Return full path to created volume, raise
+        libvirtError if it can not be created"""
+        fmt = ET.fromstring(src.XMLDesc(0)).find('.//target/format').get('type')
+        st = state(self.conn)
+        p = st.pool(pool)
+        spath = st.pool_xml(pool).find('.//path').text
+        tmpl = Disk(self.conn, pool).vol_tmpl(fmt, name, src.info()[1], spath,
+                allocation=allocation)
+        try:
+            p.createXMLFrom(tmpl, src, 0)
+        finally:
+            st.drop('volume', pool)
+        return spath + '/' + name
+
+    def clone(self, key, name, pool):
+        """Create volume with given name in given pool as hypervisor side
+        copy of cached image. Return full path to created volume or None if
+        image is not cached"""
+        volname = self.vol_name(key)
+        src = self.find(key)
+        if not src:
+            return None
+        print('Cloning cached volume {0} into {1}'.format(volname, name))
+        try:
+            path = self.copy(src, name, pool)
+        except libvirt.libvirtError:
+            sys.exit(1)
+        self.touch(volname)
+        return path
+
+    def add(self, key, image, info, chunk=CHUNK_SIZE, algo=None):
+        """Upload image probed by probe_image into cache, return 1 on
+        success. Image is uploaded into part volume of its own and copied
+        into cache volume once upload is complete and verified, so cache
+        volume is never partial. Part volume is always removed, volumes
+        created by others are left alone"""
+        volname = self.vol_name(key)
+        disk = Disk(self.conn, self.pool, chunk)
+        state(self.conn).drop('volume', self.pool)
+        if self.find(key):
+            # Filled meanwhile by another host or process
+            return 1
+        part = '{0}.part-{1}'.format(volname, uuid.uuid4().hex[:8])
+        disk.create_image_vol(part, info)
+        ok = 0
+        try:
+            if disk.upload_vol(part, image, sparse=info['sparse'],
+                    size=info['apparent'], algo=algo, convert=info['convert'],
+                    resumable=False):
+                # Holes of part volume stay holes in file based pools
+                lvm = state(self.conn).pool_xml(self.pool).get('type') == 'logical'
+                allocation = None if lvm else 0
+                print('Moving {0} into {1}'.format(part, volname))
+                try:
+                    self.copy(disk.vol_obj(part), volname, self.pool, allocation)
+                except libvirt.libvirtError:
+                    # Cache volume could have been created by someone else
+                    state(self.conn).drop('volume', self.pool)
+                ok = int(self.find(key) is not None)
+        finally:
+            vol = disk.find_vol(part)
+            try:
+                if vol:
+                    vol.delete(0)
+            except libvirt.libvirtError:
+                pass
+            state(self.conn).drop('volume', self.pool)
+        if not ok:
             return 0
+        self.touch(volname)
         return 1
 
+    def prune(self, max_size=None, max_age=None):
+        """Remove least recently used cache volumes until their total size
+        fits max size in bytes and those not used for max age in seconds.
+        Return list of removed volume names"""
+        vols = self.volumes()
+        total = sum(v[1] for v in vols)
+        removed = []
+        for v, size, used in vols:
+            if not (max_size is not None and total > max_size or
+                    max_age is not None and time.time() - used > max_age):
+                continue
+            try:
+                v.delete(0)
+            except libvirt.libvirtError:
+                continue
+            total -= size
+            self.touch(v.name(), remove=True)
+            removed.append(v.name())
+        return removed
+
+
+class Qcow2Image:
+    """Read only file object of raw guest view of qcow2 image. Clusters are
+    looked up in L1 and L2 tables, unallocated and zero clusters read as
+    zeros and compressed clusters are inflated. Images with backing file,
+    encryption or external data file are not supported.
+    Takes binary file object of qcow2 image as argument
+    """
+    offset_mask = 0x00fffffffffffe00
+    compressed = 1 << 62
+
+    def __init__(self, fileobj):
+        self.f = fileobj
+        head = fileobj.read(104)
+        if head[:4] != b'QFI\xfb':
+            raise ValueError('Not a qcow2 image')
+        (version, backing, _, self.cluster_bits, self.size, crypt, l1_size,
+                l1_offset) = struct.unpack_from('>IQIIQIIQ', head, 4)
+        features = 0
+        if version >= 3:
+            features, = struct.unpack_from('>Q', head, 72)
+        # Only dirty bit of incompatible features is harmless for reading
+        if backing or crypt or features & ~1:
+            raise ValueError('Unsupported qcow2 image features')
+        self.cluster = 1 << self.cluster_bits
+        self.l2_entries = self.cluster // 8
+        fileobj.seek(l1_offset)
+        self.l1 = struct.unpack('>{0}Q'.format(l1_size),
+                fileobj.read(l1_size * 8))
+        self.l2_index = None
+        self.l2 = None
+        self.inflated = (None, None)
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def entry(self, index):
+        """Return L2 entry of guest cluster, 0 if it is not allocated"""
+        l1_index, l2_index = divmod(index, self.l2_entries)
+        if l1_index >= len(self.l1):
+            return 0
+        if l1_index != self.l2_index:
+            offset = self.l1[l1_index] & self.offset_mask
+            if not offset:
+                return 0
+            self.f.seek(offset)
+            self.l2 = struct.unpack('>{0}Q'.format(self.l2_entries),
+                    self.f.read(self.cluster))
+            self.l2_index = l1_index
+        return self.l2[l2_index]
+
+    def has_data(self, entry):
+        """Check if L2 entry points to cluster data"""
+        if entry & self.compressed:
+            return True
+        return bool(entry & self.offset_mask) and not entry & 1
+
+    def inflate(self, entry):
+        """Return data of compressed cluster"""
+        if self.inflated[0] != entry:
+            bits = 62 - (self.cluster_bits - 8)
+            host = entry & ((1 << bits) - 1)
+            sectors = ((entry >> bits) & ((1 << (self.cluster_bits - 8)) - 1)) + 1
+            self.f.seek(host)
+            data = self.f.read(sectors * 512 - (host & 511))
+            data = zlib.decompressobj(-15).decompress(data, self.cluster)
+            self.inflated = (entry, data.ljust(self.cluster, b'\0'))
+        return self.inflated[1]
+
+    def extents(self):
+        """Return list of (offset, length, is_data) extents of guest view,
+        clusters without data are holes"""
+        extents = []
+
+        def add(offset, length, is_data):
+            if extents and extents[-1][2] == is_data:
+                extents[-1][1] += length
+            else:
+                extents.append([offset, length, is_data])
+        span = self.l2_entries * self.cluster
+        for l1_index in range(-(-self.size // span)):
+            offset = l1_index * span
+            if l1_index >= len(self.l1) or not self.l1[l1_index] & self.offset_mask:
+                add(offset, span, False)
+                continue
+            for i in range(self.l2_entries):
+                add(offset + i * self.cluster, self.cluster,
+                        self.has_data(self.entry(l1_index * self.l2_entries + i)))
+        # Last table may map beyond end of virtual disk
+        while extents and extents[-1][0] >= self.size:
+            extents.pop()
+        if extents:
+            extents[-1][1] = self.size - extents[-1][0]
+        return [tuple(e) for e in extents]
+
+    def read(self, n=-1):
+        """Read up to n bytes of guest view from current position"""
+        if n < 0:
+            n = self.size
+        n = min(n, self.size - self.pos)
+        out = []
+        while n > 0:
+            index, within = divmod(self.pos, self.cluster)
+            entry = self.entry(index)
+            take = min(n, self.cluster - within)
+            if entry & self.compressed:
+                data = self.inflate(entry)[within:within + take]
+            elif self.has_data(entry):
+                # Merge clusters following each other in image file into
+                # single read
+                host = entry & self.offset_mask
+                k = 1
+                while take < n:
+                    e = self.entry(index + k)
+                    if (e & self.compressed or not self.has_data(e) or
+                            e & self.offset_mask != host + k * self.cluster):
+                        break
+                    take = min(n, take + self.cluster)
+                    k += 1
+                self.f.seek(host + within)
+                data = self.f.read(take).ljust(take, b'\0')
+            else:
+                data = bytes(take)
+            out.append(data)
+            self.pos += take
+            n -= take
+        return b''.join(out)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.f.close()
+
+
+class BlockMap:
+    """Checksums of fixed size blocks of exported volume, kept next to the
+    export so the next one can be made incremental against it. With block
+    map of previous export given, blocks which differ from it are written
+    into delta file as (index, length) records followed by data, zero
+    filled blocks as records without data. Delta file starts with volume
+    size, block size and identifier of previous export and ends with
+    identifier of this one.
+    Takes volume size and optionally block map of previous export
+    """
+    block = 1024 * 1024
+    magic = b'VIRTUPD1'
+    end = 2 ** 64 - 1
+
+    def __init__(self, size, prev=None):
+        self.size = size
+        self.prev = prev
+        if prev:
+            self.block = prev['block']
+        self.out = None
+        self.sums = []
+        self.hash = Checkpoint.new_hash()
+        self.filled = 0
+        self.data = []
+        self.zero_sum = None
+        self.changed = 0
+
+    @staticmethod
+    def path(image):
+        """Return path of block map of image file"""
+        return image + '.blockmap'
+
+    @staticmethod
+    def load(image):
+        """Return block map saved next to image file, None if there is none"""
+        try:
+            with open(BlockMap.path(image)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, image):
+        """Write block map next to image file"""
+        with open(self.path(image), 'w') as f:
+            json.dump({'size': self.size, 'block': self.block, 'id': self.id(),
+                       'sums': self.sums}, f)
+
+    def id(self):
+        """Return identifier of export, checksum of its block checksums"""
+        h = Checkpoint.new_hash()
+        h.update(''.join(self.sums).encode())
+        return h.hexdigest()
+
+    def start(self, out):
+        """Write header of delta file, changed blocks are written into it"""
+        self.out = out
+        out.write(self.magic + struct.pack('>QI', self.size, self.block) +
+                bytes.fromhex(self.prev['id']))
+
+    def feed(self, data):
+        """Account exported data"""
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.block - self.filled)
+            self.hash.update(view[:n])
+            if self.out:
+                self.data.append(bytes(view[:n]))
+            self.filled += n
+            view = view[n:]
+            if self.filled == self.block:
+                self.next_block()
+
+    def feed_zeros(self, length):
+        """Account exported hole"""
+        while length:
+            if not self.filled and length >= self.block:
+                # Whole block of zeros, checksum is computed only once
+                self.add(self.zero(), None)
+                length -= self.block
+                continue
+            n = min(length, self.block - self.filled)
+            self.feed(bytes(n))
+            length -= n
+
+    def update_file(self, fileobj, length):
+        """Account data read from beginning of file"""
+        while length:
+            data = fileobj.read(min(length, self.block))
+            if not data:
+                break
+            self.feed(data)
+            length -= len(data)
+
+    def zero(self):
+        """Return checksum of zero filled block"""
+        if self.zero_sum is None:
+            h = Checkpoint.new_hash()
+            h.update(bytes(self.block))
+            self.zero_sum = h.hexdigest()
+        return self.zero_sum
+
+    def next_block(self):
+        """Store checksum of completed block"""
+        self.add(self.hash.hexdigest(), b''.join(self.data))
+        self.hash = Checkpoint.new_hash()
+        self.filled = 0
+        self.data = []
+
+    def add(self, checksum, data):
+        """Store block checksum, write block into delta file if it changed"""
+        index = len(self.sums)
+        self.sums.append(checksum)
+        if not self.out:
+            return
+        prev = self.prev['sums']
+        if index < len(prev) and prev[index] == checksum:
+            return
+        self.changed += 1
+        if checksum == self.zero():
+            self.out.write(struct.pack('>QI', index, 0))
+        else:
+            self.out.write(struct.pack('>QI', index, len(data)) + data)
+
+    def finish(self):
+        """Account last partial block, close delta file records"""
+        if self.filled:
+            self.next_block()
+        if self.out:
+            self.out.write(struct.pack('>QI', self.end, 16) +
+                    bytes.fromhex(self.id()))
+
+
+class DeltaImage:
+    """Read only file object of image rebuilt from base image and chain of
+    delta exports, each one made against the previous. Identifiers of
+    exports are checked to follow each other.
+    Takes binary file object of base image, list of delta file paths and
+    optionally identifier of base export
+    """
+    def __init__(self, base, deltas, base_id=None):
+        self.base = base
+        self.blocks = {}
+        self.files = []
+        parent = base_id
+        for path in deltas:
+            f = open(path, 'rb')
+            self.files.append(f)
+            head = f.read(36)
+            if head[:8] != BlockMap.magic:
+                raise ValueError('{0} is not a delta export'.format(path))
+            self.size, self.block = struct.unpack_from('>QI', head, 8)
+            if parent and head[20:36].hex() != parent:
+                raise ValueError('{0} is not made against previous export'.format(path))
+            while True:
+                index, length = struct.unpack('>QI', f.read(12))
+                if index == BlockMap.end:
+                    parent = f.read(16).hex()
+                    break
+                self.blocks[index] = (f, f.tell(), length)
+                f.seek(length, os.SEEK_CUR)
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def extents(self):
+        """Return single data extent, holes are found by zero blocks"""
+        return [(0, self.size, True)]
+
+    def read(self, n=-1):
+        """Read up to n bytes of rebuilt image from current position"""
+        if n < 0:
+            n = self.size
+        n = min(n, self.size - self.pos)
+        out = []
+        while n > 0:
+            index, within = divmod(self.pos, self.block)
+            take = min(n, self.block - within)
+            if index in self.blocks:
+                f, offset, length = self.blocks[index]
+                data = b''
+                if length:
+                    f.seek(offset + within)
+                    data = f.read(min(take, length - within))
+            else:
+                # Read unchanged blocks following each other at once
+                while take < n and (self.pos + take) // self.block not in self.blocks:
+                    take = min(n, take + self.block)
+                if self.base.tell() != self.pos:
+                    self.base.seek(self.pos)
+                data = self.base.read(take)
+            # Volume might have grown since base export
+            out.append(data.ljust(take, b'\0'))
+            self.pos += take
+            n -= take
+        return b''.join(out)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = offset
+        return offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.base.close()
+        for f in self.files:
+            f.close()
+
+
+class Progress:
+    """Rate limited transfer progress indicator, prints done percentage,
+    throughput and estimated time left into stderr.
+    Takes total size of transfer, update interval in seconds and offset
+    transfer is resumed from as arguments
+    """
+    # Set when several transfers run at once and would garble each other
+    quiet = False
+
+    def __init__(self, size, interval=0.5, offset=0):
+        self.size = size
+        self.interval = interval
+        self.offset = offset
+        # Bytes processed, including holes and already transferred offset
+        self.total = offset
+        # Bytes really moved through stream
+        self.moved = 0
+        self.start = time.time()
+        self.last = 0
+
+    def update(self, nbytes, moved=True):
+        """Account processed bytes, print progress if interval passed"""
+        self.total += nbytes
+        if moved:
+            self.moved += nbytes
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.show(now)
+
+    def show(self, now):
+        """Print progress line"""
+        if self.quiet:
+            return
+        elapsed = max(now - self.start, 0.001)
+        rate = (self.total - self.offset) / elapsed
+        if self.size:
+            done = float(self.total) / self.size
+        else:
+            done = 1
+        eta = int(max(self.size - self.total, 0) / rate) if rate else 0
+        sys.stderr.write('\rdone {0:.2%} {1}/s eta {2}:{3:02}:{4:02}   '.format(
+            done, convert_bytes(rate), eta // 3600, eta // 60 % 60, eta % 60))
+
+    def finish(self):
+        """Print final progress line"""
+        if self.quiet:
+            return
+        self.show(time.time())
+        sys.stderr.write('\n')
+
+
+class StateCache:
+    """Remembers looked up domains and storage pools of connection, their
+    XML descriptions and volumes. Entries expire after INVENTORY_TTL seconds,
+    changes made by virtup drop them at once. When libvirt event loop runs
+    in background, domain and pool entries are dropped by lifecycle events
+    and expire only after INVENTORY_EVENT_TTL seconds. Hits and misses are
+    counted.
+    Takes libvirt connection as argument
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.watched = set()
+        self.callbacks = []
+        if event_thread:
+            self.watch()
+
+    def watch(self):
+        """Subscribe to events dropping entries of changed objects, kinds
+        without events keep expiring"""
+        try:
+            self.callbacks.append((self.conn.domainEventDeregisterAny,
+                    self.conn.domainEventRegisterAny(None,
+                    libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                    lambda conn, dom, event, detail, opaque:
+                        self.drop('domain', dom.name()),
+                    None)))
+            self.watched.add('domain')
+        except libvirt.libvirtError:
+            pass
+        try:
+            self.callbacks.append((self.conn.storagePoolEventDeregisterAny,
+                    self.conn.storagePoolEventRegisterAny(None,
+                    libvirt.VIR_STORAGE_POOL_EVENT_ID_LIFECYCLE,
+                    lambda conn, pool, event, detail, opaque:
+                        self.drop('pool', pool.name()),
+                    None)))
+            self.watched.add('pool')
+        except (AttributeError, libvirt.libvirtError):
+            # libvirt older than 2.0 has no storage pool events
+            pass
+
+    def close(self):
+        """Unsubscribe from events, connection might be dead already"""
+        for deregister, cb in self.callbacks:
+            try:
+                deregister(cb)
+            except libvirt.libvirtError:
+                pass
+        self.callbacks = []
+
+    def get(self, key, fetch):
+        """Return value of (kind, name, what) key, fetch() it on miss"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            ttl = INVENTORY_EVENT_TTL if key[0] in self.watched else INVENTORY_TTL
+            if entry and now - entry[0] < ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = fetch()
+        with self.lock:
+            self.entries[key] = (now, value)
+        return value
+
+    def drop(self, kind, name=None):
+        """Forget entries of object of given kind and name, entries
+        aggregating objects of that kind are forgotten too"""
+        with self.lock:
+            for key in list(self.entries):
+                if key[0] == kind and (name is None or key[1] in (name, None)):
+                    del self.entries[key]
+
+    def domain(self, name):
+        return self.get(('domain', name, 'obj'), lambda: self.conn.lookupByName(name))
+
+    def domain_xml(self, name):
+        return self.get(('domain', name, 'xml'), lambda: self.domain(name).XMLDesc(0))
+
+    def pool(self, name):
+        return self.get(('pool', name, 'obj'),
+                lambda: self.conn.storagePoolLookupByName(name))
+
+    def pool_xml(self, name):
+        """Return parsed XML description of storage pool"""
+        return self.get(('pool', name, 'xml'),
+                lambda: ET.fromstring(self.pool(name).XMLDesc(0)))
+
+    def volume(self, pool, name):
+        # Volume changes have no events, volumes always expire
+        return self.get(('volume', pool, name),
+                lambda: self.pool(pool).storageVolLookupByName(name))
+
+
+# Inventory caches of connections, daemon drops cache of connection it
+# reopens
+states = {}
+states_lock = threading.Lock()
+
+
+# Return inventory cache of connection
+def state(c):
+    with states_lock:
+        if c not in states:
+            states[c] = StateCache(c)
+        return states[c]
+
+
+class Net:
+    """Contains network based procedures, provides method to obtain virtual
+    machine ip address from libvirt DHCP leases, guest agent and hypervisor
+    arp cache.
+    Takes virtual machine name and libvirt connection object arguments
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.bridges = {}
+
+    @staticmethod
+    def ifaces(xmldesc):
+        """Return list of (MAC, network name, bridge name) for every network
+        interface of domain XML description, network name is None for
+        bridged interface and bridge name is None for network interface"""
+        ifaces = []
+        for iface in ET.fromstring(xmldesc).findall('.//devices/interface'):
+            mac = iface.find('mac')
+            source = iface.find('source')
+            if mac is None:
+                continue
+            net = bridge = None
+            if source is not None:
+                net = source.get('network')
+                bridge = source.get('bridge')
+            ifaces.append((mac.get('address').lower(), net, bridge))
+        return ifaces
+
+    @staticmethod
+    def arp_table():
+        """Read arp cache into dict of MAC -> ip address, incomplete entries
+        are skipped"""
+        table = {}
+        with open('/proc/net/arp', 'r') as f:
+            for i in f.readlines()[1:]:
+                fields = i.split()
+                if len(fields) > 3 and fields[3] != '00:00:00:00:00:00':
+                    table[fields[3].lower()] = fields[0]
+        return table
+
+    @staticmethod
+    def is_local(uri):
+        """Return True if connection URI points to local hypervisor, so its
+        arp cache is available"""
+        return re.match(r'^[\w+]+:///', uri) is not None
+
+    def libvirt_ips(self, dom, ifaces, sources=('LEASE', 'AGENT', 'ARP')):
+        """Ask libvirt for addresses of domain interfaces: DHCP leases, guest
+        agent and hypervisor arp table as seen by libvirtd. Return dict of
+        MAC -> ip address, next source is asked only for unresolved MACs"""
+        macs = set(i[0] for i in ifaces)
+        found = {}
+        if not dom.isActive():
+            return found
+        for src in sources:
+            src = getattr(libvirt, 'VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_' + src, None)
+            if src is None:
+                continue
+            try:
+                addrs = dom.interfaceAddresses(src, 0)
+            except libvirt.libvirtError:
+                continue
+            for iface in addrs.values():
+                mac = (iface.get('hwaddr') or '').lower()
+                if mac not in macs or mac in found:
+                    continue
+                for addr in iface.get('addrs') or []:
+                    if addr['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                        found[mac] = addr['addr']
+                        break
+            if len(found) == len(macs):
+                break
+        return found
+
+    def leases(self, net):
+        """Return dict of MAC -> ip address from DHCP leases of libvirt
+        managed network"""
+        found = {}
+        try:
+            leases = self.conn.networkLookupByName(net).DHCPLeases(None, 0)
+        except libvirt.libvirtError:
+            return found
+        for lease in leases:
+            if lease['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                found[lease['mac'].lower()] = lease['ipaddr']
+        return found
+
+    def used_macs(self):
+        """Return set of MAC addresses of interfaces of all domains and of
+        DHCP host reservations of all networks"""
+        macs = set()
+        for dom in self.conn.listAllDomains(0):
+            try:
+                macs.update(i[0] for i in self.ifaces(dom.XMLDesc(0)))
+            except libvirt.libvirtError:
+                pass
+        for network in self.conn.listAllNetworks(0):
+            xe = ET.fromstring(network.XMLDesc(0))
+            macs.update(h.get('mac').lower()
+                        for h in xe.findall('.//ip/dhcp/host') if h.get('mac'))
+        return macs
+
+    def reserve(self, net, mac, name):
+        """Add DHCP host entry for MAC into libvirt network with first
+        address of DHCP range not reserved, leased or used by network itself.
+        Return reserved address or None if there is no free one"""
+        network = self.conn.networkLookupByName(net)
+        xe = ET.fromstring(network.XMLDesc(0))
+        taken = set(self.leases(net).values())
+        for ip in xe.findall('.//ip'):
+            taken.add(ip.get('address'))
+            taken.update(h.get('ip') for h in ip.findall('dhcp/host'))
+        for r in xe.findall('.//ip/dhcp/range'):
+            first = ipaddress.ip_address(r.get('start'))
+            last = ipaddress.ip_address(r.get('end'))
+            if first.version != 4:
+                continue
+            for n in range(int(first), int(last) + 1):
+                addr = str(ipaddress.ip_address(n))
+                if addr in taken:
+                    continue
+                host = "<host mac='{0}' name='{1}' ip='{2}'/>".format(mac, name, addr)
+                network.update(libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST,
+                        libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1, host,
+                        self.update_flags(network))
+                return addr
+        return None
+
+    def release(self, net, mac, ip):
+        """Remove DHCP host entry of MAC from libvirt network"""
+        network = self.conn.networkLookupByName(net)
+        host = "<host mac='{0}' ip='{1}'/>".format(mac, ip)
+        network.update(libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
+                libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1, host,
+                self.update_flags(network))
+
+    @staticmethod
+    def update_flags(network):
+        """Return flags changing network configuration and running network"""
+        flags = libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG
+        if network.isActive():
+            flags |= libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE
+        return flags
+
+    @staticmethod
+    def reservations(xmldesc):
+        """Return list of (MAC, network name, ip address) of DHCP
+        reservations recorded in domain metadata"""
+        xe = ET.fromstring(xmldesc)
+        return [(i.get('mac'), i.get('network'), i.get('address'))
+                for i in xe.findall('metadata/{%s}reservations/{%s}ip' % (META_NS, META_NS))]
+
+    @staticmethod
+    def record(xmldesc, reserved):
+        """Return domain XML with reservations list of (MAC, network name,
+        ip address) recorded in its metadata"""
+        xe = ET.fromstring(xmldesc)
+        meta = xe.find('metadata')
+        if meta is None:
+            meta = ET.SubElement(xe, 'metadata')
+        res = ET.SubElement(meta, 'virtup:reservations')
+        res.set('xmlns:virtup', META_NS)
+        for mac, net, ip in reserved:
+            ET.SubElement(res, 'virtup:ip', mac=mac, network=net, address=ip)
+        return ET.tostring(xe, encoding="unicode")
+
+    def bridge(self, net, bridge):
+        """Return host bridge of interface, network bridges are cached"""
+        if bridge or not net:
+            return bridge
+        if net not in self.bridges:
+            try:
+                self.bridges[net] = self.conn.networkLookupByName(net).bridgeName()
+            except libvirt.libvirtError:
+                self.bridges[net] = None
+        return self.bridges[net]
+
+    @staticmethod
+    def get_subnet(ifname):
+        """Return list of CIDRs of interface got from /bin/ip output"""
+        patt = re.compile(r'inet\s*(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}/\d{1,3})')
+        return patt.findall(os.popen('ip a s ' + ifname).read())
+
+    @staticmethod
+    def hosts(cidrs):
+        """Lazily yield host addresses of networks given in CIDR notation,
+        network and broadcast addresses are skipped, networks shared by
+        several CIDRs are walked once"""
+        seen = set()
+        for cidr in cidrs:
+            net = ipaddress.ip_interface(cidr).network
+            if net in seen:
+                continue
+            seen.add(net)
+            for host in net.hosts():
+                yield str(host)
+
+    async def ips(self, names, emit, timeout=IP_TIMEOUT, limit=IP_CONCURRENCY):
+        """Resolve addresses of every network interface of given domains.
+        emit(name, mac, ip) is called as soon as address of interface is
+        known, with None ip for interfaces not resolved until timeout.
+        Addresses reserved by virtup are taken from domain metadata.
+        Libvirt is asked for all domains concurrently, but not more than
+        limit at once. DHCP leases are fetched once per network, local arp
+        cache is read once and every bridge subnet is probed at most once"""
+        deadline = time.time() + timeout
+        sem = asyncio.Semaphore(limit)
+        # MAC -> (domain name, network name, bridge name)
+        pending = {}
+
+        def query(name):
+            st = state(self.conn)
+            dom = st.domain(name)
+            xmldesc = st.domain_xml(name)
+            ifaces = self.ifaces(xmldesc)
+            # Reserved addresses are known without asking anybody
+            found = dict((r[0], r[2]) for r in self.reservations(xmldesc))
+            if len(found) < len(ifaces):
+                found.update(self.libvirt_ips(dom, ifaces))
+            return ifaces, found
+
+        async def ask(name):
+            async with sem:
+                try:
+                    ifaces, found = await asyncio.to_thread(query, name)
+                except libvirt.libvirtError:
+                    return
+            for mac, net, bridge in ifaces:
+                if mac in found:
+                    emit(name, mac, found[mac])
+                else:
+                    pending[mac] = (name, net, bridge)
+
+        def resolved(found):
+            for mac in [m for m in pending if m in found]:
+                emit(pending.pop(mac)[0], mac, found[mac])
+
+        await asyncio.gather(*[ask(name) for name in names])
+        for net in set(p[1] for p in pending.values() if p[1]):
+            resolved(await asyncio.to_thread(self.leases, net))
+        if pending and self.is_local(self.conn.getURI()):
+            resolved(self.arp_table())
+            # Group what is left by host bridge, so each subnet is probed once
+            groups = {}
+            for mac, (name, net, bridge) in pending.items():
+                groups.setdefault(self.bridge(net, bridge), []).append(mac)
+
+            async def scan(bridge, macs):
+                async with sem:
+                    hosts = self.hosts(self.get_subnet(bridge))
+                    resolved(await probe(macs, hosts, deadline))
+            await asyncio.gather(*[scan(b, m) for b, m in groups.items() if b])
+        for mac in list(pending):
+            emit(pending.pop(mac)[0], mac, None)
+
+
+class Host:
+    """NUMA topology of hypervisor host and CPUs its domains are pinned to.
+    Takes libvirt connection as argument
+    """
+    # Bytes in unit of libvirt memory element
+    units = {'b': 1, 'bytes': 1, 'kb': 10 ** 3, 'k': 2 ** 10, 'kib': 2 ** 10,
+             'mb': 10 ** 6, 'm': 2 ** 20, 'mib': 2 ** 20, 'gb': 10 ** 9,
+             'g': 2 ** 30, 'gib': 2 ** 30, 'tb': 10 ** 12, 't': 2 ** 40,
+             'tib': 2 ** 40}
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @staticmethod
+    def parse_cpuset(cpuset):
+        """Return set of CPUs in libvirt cpuset string like 0-3,^2,6"""
+        cpus, excluded = set(), set()
+        for part in cpuset.replace(' ', '').split(','):
+            target = cpus
+            if part.startswith('^'):
+                target, part = excluded, part[1:]
+            if '-' in part:
+                first, last = part.split('-')
+                target.update(range(int(first), int(last) + 1))
+            elif part:
+                target.add(int(part))
+        return cpus - excluded
+
+    @staticmethod
+    def format_cpuset(cpus):
+        """Return libvirt cpuset string of CPUs, runs are joined in ranges"""
+        parts = []
+        for cpu in sorted(cpus):
+            if parts and parts[-1][1] == cpu - 1:
+                parts[-1][1] = cpu
+            else:
+                parts.append([cpu, cpu])
+        return ','.join(str(a) if a == b else '{0}-{1}'.format(a, b)
+                        for a, b in parts)
+
+    @classmethod
+    def memory_kib(cls, elem):
+        """Return size of libvirt memory element in KiB"""
+        unit = cls.units.get(elem.get('unit', 'KiB').lower(), 2 ** 10)
+        return int(elem.text) * unit // 1024
+
+    def cells(self):
+        """Return list of (cell id, cores, hugepage sizes in KiB) of host,
+        core is tuple of online CPUs sharing it"""
+        try:
+            online = self.conn.getCPUMap(0)[1]
+        except libvirt.libvirtError:
+            online = None
+        xe = ET.fromstring(self.conn.getCapabilities())
+        cells = []
+        for cell in xe.findall('./host/topology/cells/cell'):
+            cores = {}
+            for cpu in cell.findall('./cpus/cpu'):
+                cpu_id = int(cpu.get('id'))
+                if online is not None and (cpu_id >= len(online) or not online[cpu_id]):
+                    continue
+                # Threads of one core are listed as its siblings
+                core = cpu.get('siblings') or str(cpu_id)
+                cores.setdefault(core, []).append(cpu_id)
+            # Base page size is not a hugepage
+            base = min([int(p.get('size')) for p in cell.findall('./pages')] or [0])
+            pages = sorted(int(p.get('size')) for p in cell.findall('./pages')
+                           if int(p.get('size')) != base)
+            cells.append((int(cell.get('id')),
+                          sorted(tuple(sorted(c)) for c in cores.values()), pages))
+        return cells
+
+    def free_memory(self, cell):
+        """Return free memory of NUMA cell in KiB"""
+        return self.conn.getCellsFreeMemory(cell, 1)[0] // 1024
+
+    def free_pages(self, cell, size):
+        """Return number of free hugepages of given size in KiB of NUMA cell"""
+        try:
+            return self.conn.getFreePages([size], cell, 1).get(cell, {}).get(size, 0)
+        except libvirt.libvirtError:
+            return 0
+
+    def pinned(self):
+        """Return set of CPUs vCPUs, emulator and I/O threads of defined
+        domains are pinned to"""
+        cpus = set()
+        for dom in self.conn.listAllDomains(0):
+            xe = ET.fromstring(dom.XMLDesc(0))
+            for pin in xe.findall('./cputune/*[@cpuset]'):
+                cpus |= self.parse_cpuset(pin.get('cpuset'))
+        return cpus
+
+
+class Waiter:
+    """Waits until started domains boot, driven by libvirt events. Domain
+    lifecycle and guest agent events trigger checks of domains. Libvirt has
+    no events for DHCP leases, so they are also checked on timer backing off
+    up to WAIT_BACKOFF seconds, subnets are never probed.
+    Domain is ready when it has ip address (ip), when its guest agent is
+    connected and reports address (agent) or when ssh port of its address
+    accepts connections (ssh).
+    Takes libvirt connection, what to wait for and timeout in seconds
+    """
+    def __init__(self, conn, mode='ip', timeout=WAIT_TIMEOUT):
+        self.conn = conn
+        self.mode = mode
+        self.timeout = timeout
+        self.net = Net(conn)
+        self.pending = {}
+        self.dirty = set()
+
+    def lifecycle(self, conn, dom, event, detail, opaque):
+        """Domain lifecycle event callback"""
+        if dom.name() not in self.pending:
+            return
+        if event in (libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                libvirt.VIR_DOMAIN_EVENT_CRASHED):
+            self.pending[dom.name()] = 'stopped'
+        self.dirty.add(dom.name())
+
+    def agent(self, conn, dom, state, reason, opaque):
+        """Guest agent lifecycle event callback"""
+        if dom.name() in self.pending:
+            self.dirty.add(dom.name())
+
+    def tick(self, timer, opaque):
+        """Timer callback, marks all domains for check and backs off"""
+        self.dirty.update(self.pending)
+        self.interval = min(self.interval * 2, WAIT_BACKOFF)
+        libvirt.virEventUpdateTimeout(timer, int(self.interval * 1000))
+
+    def check(self, name):
+        """Return address of ready domain, None if it is not ready yet"""
+        st = state(self.conn)
+        dom = st.domain(name)
+        ifaces = self.net.ifaces(st.domain_xml(name))
+        if not ifaces:
+            return None
+        if self.mode == 'agent':
+            found = self.net.libvirt_ips(dom, ifaces, ('AGENT',))
+        else:
+            found = self.net.libvirt_ips(dom, ifaces)
+            for net in set(i[1] for i in ifaces if i[1] and i[0] not in found):
+                found.update(self.net.leases(net))
+        ip = next((found[i[0]] for i in ifaces if i[0] in found), None)
+        if ip and self.mode == 'ssh':
+            try:
+                socket.create_connection((ip, 22), timeout=1).close()
+            except OSError:
+                return None
+        return ip
+
+    def run(self, names, emit):
+        """Wait for domains, emit(name, ip) is called as soon as domain is
+        ready, with None ip for domains stopped or not ready in time.
+        Return True if all domains got ready"""
+        deadline = time.time() + self.timeout
+        self.pending = dict((n, None) for n in names)
+        self.dirty = set(names)
+        self.interval = 0.5
+        callbacks = [self.conn.domainEventRegisterAny(None,
+                libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self.lifecycle, None)]
+        if hasattr(libvirt, 'VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE'):
+            callbacks.append(self.conn.domainEventRegisterAny(None,
+                    libvirt.VIR_DOMAIN_EVENT_ID_AGENT_LIFECYCLE, self.agent, None))
+        timer = libvirt.virEventAddTimeout(int(self.interval * 1000), self.tick, None)
+        ok = True
+        try:
+            while self.pending:
+                for name in list(self.dirty & set(self.pending)):
+                    self.dirty.discard(name)
+                    ip = None
+                    if not self.pending[name]:
+                        try:
+                            ip = self.check(name)
+                        except libvirt.libvirtError:
+                            self.pending[name] = 'failed'
+                    if ip or self.pending[name]:
+                        del self.pending[name]
+                        ok = ok and bool(ip)
+                        emit(name, ip)
+                if not self.pending:
+                    break
+                if time.time() >= deadline:
+                    for name in self.pending:
+                        emit(name, None)
+                    return False
+                libvirt.virEventRunDefaultImpl()
+        finally:
+            libvirt.virEventRemoveTimeout(timer)
+            for cb in callbacks:
+                self.conn.domainEventDeregisterAny(cb)
+        return ok
+
+
+# Trigger arp resolution of hosts by sending empty UDP datagram to each of
+# them in batches, return dict of MAC -> ip for MACs showing up in arp cache.
+# Probing stops when wanted amount of MACs (all by default) is found or when
+# deadline passes. Nothing is forked, hosts iterable is consumed lazily and
+# amount of requests in flight is bounded by batch size
+async def probe(macs, hosts, deadline, batch=PROBE_BATCH, want=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    hosts = iter(hosts)
+    want = want or len(macs)
+    found = {}
+    try:
+        while True:
+            chunk = list(itertools.islice(hosts, batch))
+            if not chunk:
+                break
+            for host in chunk:
+                try:
+                    sock.sendto(b'', (host, 9))
+                except OSError:
+                    pass
+            # Give neighbours time to answer arp requests
+            await asyncio.sleep(PROBE_WAIT)
+            table = Net.arp_table()
+            found = dict((mac, table[mac]) for mac in macs if mac in table)
+            if len(found) >= want or time.time() >= deadline:
+                break
+    finally:
+        sock.close()
+    return found
+
+
+# Return list of (offset, length, is_data) extents of opened file
+def file_extents(fileobj, size):
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size, True)]
+    fd = fileobj.fileno()
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            # ENXIO means there is only hole till the end of file, other
+            # errors mean filesystem can not report holes
+            extents.append((offset, size - offset, e.errno != errno.ENXIO))
+            break
+        if data > offset:
+            extents.append((offset, data - offset, False))
+        hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+        extents.append((data, hole - data, True))
+        offset = hole
+    return extents
+
+
+# Cut off extents preceding offset transfer starts from
+def clip_extents(extents, offset):
+    clipped = []
+    for start, length, is_data in extents:
+        if start + length <= offset:
+            continue
+        if start < offset:
+            length -= offset - start
+            start = offset
+        clipped.append((start, length, is_data))
+    return clipped
+
+
+# Read file by blocks, yield (hole_length, data) pairs. In sparse mode file
+# holes and zero filled blocks are merged and reported as hole length,
+# otherwise only data is returned. Extents are looked up in file unless given,
+# streams which can not report holes pass single data extent
+def read_sparse(fileobj, size, blocksize, sparse=True, extents=None):
+    if not sparse:
+        while True:
+            data = fileobj.read(blocksize)
+            if not data:
+                break
+            yield 0, data
+        return
+    zero = bytes(blocksize)
+    hole = 0
+    if extents is None:
+        extents = file_extents(fileobj, size)
+    for offset, length, is_data in extents:
+        if not is_data:
+            hole += length
+            continue
+        if fileobj.tell() != offset:
+            fileobj.seek(offset)
+        while length > 0:
+            data = fileobj.read(min(blocksize, length))
+            if not data:
+                break
+            length -= len(data)
+            if data == zero[:len(data)]:
+                hole += len(data)
+                continue
+            if hole:
+                yield hole, None
+                hole = 0
+            yield 0, data
+    if hole:
+        yield hole, None
+
+
+# Consume items of producer iterable in calling thread while producer runs in
+# worker thread. Both sides are connected with bounded queue so they overlap
+# but do not run away from each other. Exception raised by producer is
+# re-raised in calling thread, failed consumer stops producer
+def pipeline(producer, consumer, depth=QUEUE_DEPTH):
+    items = queue.Queue(depth)
+    stop = threading.Event()
+    error = []
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in producer:
+                if not put(item):
+                    return
+        except Exception as e:
+            error.append(e)
+        put(end)
+
+    t = threading.Thread(target=worker, daemon=True)
+    t.start()
+    try:
+        while True:
+            item = items.get()
+            if item is end:
+                break
+            consumer(item)
+    finally:
+        stop.set()
+        t.join()
+    if error:
+        raise error[0]
+
+
+# Generate random MAC address
+def randomMAC():
+    mac = [0x00, 0x16, 0x3e,
+        random.randint(0x00, 0x7f),
+        random.randint(0x00, 0xff),
+        random.randint(0x00, 0xff)]
+    return ':'.join(map(lambda x: "%02x" % x, mac))
+
+
+# MAC addresses in use, indexed on first allocation
+mac_index = None
+# Serializes allocation of MAC and ip addresses by parallel provisioning
+alloc_lock = threading.Lock()
+
+
+# Return random MAC address not used by any domain or DHCP reservation
+def allocate_mac():
+    global mac_index
+    with alloc_lock:
+        if mac_index is None:
+            mac_index = Net(conn).used_macs()
+        while True:
+            mac = randomMAC()
+            if mac not in mac_index:
+                mac_index.add(mac)
+                return mac
+
+
+# Reserve DHCP address for every interface of domain XML attached to libvirt
+# network, return XML with reservations recorded in domain metadata
+def reserve_ips(xmldesc, name):
+    net = Net(conn)
+    reserved = []
+    with alloc_lock:
+        for mac, network, bridge in Net.ifaces(xmldesc):
+            if not network:
+                print('Address of {0} can not be reserved in bridge {1}'.format(
+                        mac, bridge))
+                continue
+            try:
+                ip = net.reserve(network, mac, name)
+            except libvirt.libvirtError:
+                ip = None
+            if not ip:
+                print('No free address to reserve in network {0}'.format(network))
+                continue
+            print('Address {0} reserved for {1}'.format(ip, mac))
+            reserved.append((mac, network, ip))
+    if not reserved:
+        return xmldesc
+    return Net.record(xmldesc, reserved)
+
+
+# Remove DHCP reservations recorded in domain XML, only those of its own
+# interfaces, so reservation copied from another machine is not touched
+def release_ips(xmldesc):
+    net = Net(conn)
+    macs = set(i[0] for i in Net.ifaces(xmldesc))
+    for mac, network, ip in Net.reservations(xmldesc):
+        if mac.lower() not in macs:
+            continue
+        try:
+            net.release(network, mac, ip)
+            print('Address {0} released'.format(ip))
+        except libvirt.libvirtError:
+            pass
+
+
+# CPUs held by pinned domains and memory in KiB claimed from NUMA cells by
+# (cell, page size) in this process, indexed on first placement
+host_index = None
+
+
+# Pin domain XML to NUMA cell of host with enough free memory and cores not
+# held by other domains: emulator thread gets one core, vCPUs get CPUs of
+# the following ones and memory is allocated from that cell only,
+# optionally from its hugepages. Cell with most free memory is preferred.
+# Return XML with cputune, numatune and memoryBacking set
+def place_domain(xmldesc, name, hugepages=False):
+    global host_index
+    xe = ET.fromstring(xmldesc)
+    vcpus = int(xe.find('./vcpu').text)
+    mem = Host.memory_kib(xe.find('./memory'))
+    host = Host(conn)
+    with alloc_lock:
+        if host_index is None:
+            host_index = {'cpus': host.pinned(), 'claims': {}}
+        held, claims = host_index['cpus'], host_index['claims']
+        best = None
+        for cell, cores, pages in host.cells():
+            cores = [c for c in cores if not held.intersection(c)]
+            if len(cores) < 2 or sum(len(c) for c in cores[1:]) < vcpus:
+                continue
+            if hugepages:
+                # Largest page size memory is a multiple of with enough free pages
+                page = None
+                for size in reversed(pages):
+                    free = host.free_pages(cell, size) * size - claims.get((cell, size), 0)
+                    if mem % size == 0 and free >= mem:
+                        page = size
+                        break
+                if page is None:
+                    continue
+            else:
+                page = 0
+                free = host.free_memory(cell) - claims.get((cell, 0), 0)
+                if free < mem:
+                    continue
+            if best is None or free > best[0]:
+                best = (free, cell, cores, page)
+        if best is None:
+            print('No NUMA node has free cores for {0} vCPUs and emulator and {1} '
+                  'of free {2}memory for {3}'.format(vcpus, convert_bytes(mem * 1024),
+                  'hugepage ' if hugepages else '', name))
+            sys.exit(1)
+        free, cell, cores, page = best
+        emulator = cores[0]
+        taken, threads = [], []
+        for core in cores[1:]:
+            if len(threads) >= vcpus:
+                break
+            taken.append(core)
+            threads.extend(core)
+        threads = threads[:vcpus]
+        # Whole cores are held, so no other domain shares their threads
+        held.update(emulator)
+        for core in taken:
+            held.update(core)
+        claims[(cell, page)] = claims.get((cell, page), 0) + mem
+    for tag in ('cputune', 'numatune', 'memoryBacking'):
+        for elem in xe.findall('./' + tag):
+            xe.remove(elem)
+    vcpu = xe.find('./vcpu')
+    vcpu.set('placement', 'static')
+    vcpu.set('cpuset', Host.format_cpuset(threads))
+    pos = list(xe).index(vcpu) + 1
+    cputune = ET.Element('cputune')
+    for i, cpu in enumerate(threads):
+        ET.SubElement(cputune, 'vcpupin', vcpu=str(i), cpuset=str(cpu))
+    ET.SubElement(cputune, 'emulatorpin', cpuset=Host.format_cpuset(emulator))
+    # I/O threads share core of emulator
+    iothreads = xe.find('./iothreads')
+    for i in range(int(iothreads.text) if iothreads is not None else 0):
+        ET.SubElement(cputune, 'iothreadpin', iothread=str(i + 1),
+                      cpuset=Host.format_cpuset(emulator))
+    numatune = ET.Element('numatune')
+    ET.SubElement(numatune, 'memory', mode='strict', nodeset=str(cell))
+    xe.insert(pos, cputune)
+    xe.insert(pos + 1, numatune)
+    if page:
+        backing = ET.Element('memoryBacking')
+        ET.SubElement(ET.SubElement(backing, 'hugepages'), 'page',
+                      size=str(page), unit='KiB', nodeset=str(cell))
+        xe.insert(pos + 2, backing)
+    print('{0} pinned to NUMA node {1}: vCPUs {2}, emulator {3}{4}'.format(
+            name, cell, Host.format_cpuset(threads), Host.format_cpuset(emulator),
+            ', {0}K hugepages'.format(page) if page else ''))
+    return ET.tostring(xe, encoding='unicode')
+
+
+# Define domain from XML, reserving DHCP addresses of its interfaces first
+# if asked. Reservations are released if domain can not be defined. With
+# perf profile domain is pinned to NUMA node first
+def define_domain(xmldesc, name, reserve=False, perf=False, hugepages=False):
+    if perf or hugepages:
+        try:
+            xmldesc = place_domain(xmldesc, name, hugepages)
+        except libvirt.libvirtError:
+            sys.exit(1)
+    if reserve:
+        xmldesc = reserve_ips(xmldesc, name)
+    try:
+        conn.defineXML(xmldesc)
+    except libvirt.libvirtError:
+        release_ips(xmldesc)
+        sys.exit(1)
+    state(conn).drop('domain', name)
+
+
+# Return compression of image file guessed by its extension
+def image_codec(filepath):
+    for ext, codec in (('.xz', 'xz'), ('.gz', 'gz'), ('.zst', 'zst')):
+        if filepath.lower().endswith(ext):
+            return codec
+    return None
+
+
+# Open image file for binary reading or writing, compressed images are
+# transparently decompressed or compressed according to file extension
+def open_image(filepath, mode='rb'):
+    codec = image_codec(filepath)
+    if codec == 'xz':
+        return lzma.open(filepath, mode)
+    if codec == 'gz':
+        return gzip.open(filepath, mode)
+    if codec == 'zst':
+        if zstandard is None:
+            print('Python zstandard module is required for .zst images')
+            sys.exit(1)
+        if 'w' in mode:
+            return zstandard.ZstdCompressor(threads=-1).stream_writer(
+                open(filepath, mode))
+        return zstandard.ZstdDecompressor().stream_reader(open(filepath, mode))
+    return open(filepath, mode)
+
+
+# Open image file for reading, with chain of delta exports applied over it
+# if given
+def open_source(filepath, deltas=None):
+    f = open_image(filepath)
+    if not deltas:
+        return f
+    base = BlockMap.load(filepath)
+    try:
+        return DeltaImage(f, deltas, base and base['id'])
+    except (ValueError, struct.error, IOError) as e:
+        f.close()
+        print(e if not isinstance(e, struct.error) else 'Truncated delta export')
+        sys.exit(1)
+
+
+# Decode xz variable length integer, return value and position after it
+def xz_varint(buf, pos):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+# Return uncompressed size of xz file summed from indexes of its streams,
+# None if file can not be parsed
+def xz_size(filepath):
+    total = 0
+    try:
+        with open(filepath, 'rb') as f:
+            end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                # Skip stream padding
+                f.seek(end - 4)
+                if f.read(4) == bytes(4):
+                    end -= 4
+                    continue
+                f.seek(end - 12)
+                footer = f.read(12)
+                if footer[10:] != b'YZ':
+                    return None
+                index_size = (struct.unpack('<I', footer[4:8])[0] + 1) * 4
+                f.seek(end - 12 - index_size)
+                index = f.read(index_size)
+                if index[0] != 0:
+                    return None
+                count, pos = xz_varint(index, 1)
+                blocks = 0
+                for i in range(count):
+                    unpadded, pos = xz_varint(index, pos)
+                    usize, pos = xz_varint(index, pos)
+                    blocks += (unpadded + 3) & ~3
+                    total += usize
+                # Previous stream ends before this stream header
+                end -= 12 + blocks + index_size + 12
+    except (OSError, IndexError, struct.error):
+        return None
+    return total
+
+
+# Return size of image data. For compressed image size of uncompressed data,
+# read from xz index or counted by decompressing image without storing it
+def image_size(filepath):
+    codec = image_codec(filepath)
+    if not codec:
+        return os.path.getsize(filepath)
+    if codec == 'xz':
+        size = xz_size(filepath)
+        if size is not None:
+            return size
+    size = 0
+    buf = bytearray(CHUNK_MAX)
+    with open_image(filepath) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            size += n
+    return size
+
+
+# Probe image header, return dict with format, virtual size and cluster
+# size in bytes, backing file, apparent size of image data and bytes allocated
+# for it on disk, and whether sparse transfer is worth scanning image for.
+# Image rebuilt from delta exports is probed if they are given
+def probe_image(filepath, deltas=None):
+    info = {'format': 'raw', 'virtual_size': None, 'cluster_size': None,
+            'backing': None, 'convert': False}
+    # Rebuilt image is read only through delta chain
+    codec = image_codec(filepath) or deltas
+    try:
+        with open_source(filepath, deltas) as f:
+            head = f.read(PROBE_HEAD)
+            if deltas:
+                info['apparent'] = f.size
+    except Exception:
+        head = b''
+    if not deltas:
+        info['apparent'] = image_size(filepath)
+    if codec:
+        info['allocated'] = info['apparent']
+    else:
+        st = os.stat(filepath)
+        info['allocated'] = min(st.st_blocks * 512, st.st_size)
+    try:
+        if head[:4] == b'QFI\xfb':
+            probe_qcow2(head, info)
+        elif head[64:68] == b'\x7f\x10\xda\xbe':
+            probe_vdi(head, info)
+        elif head[:4] == b'KDMV' or head.startswith(b'# Disk DescriptorFile'):
+            probe_vmdk(head, info)
+        elif head[:8] == b'vhdxfile' and not codec:
+            probe_vhdx(filepath, info)
+        elif head[:8] == b'conectix':
+            probe_vhd(head, filepath, info)
+        elif not codec and info['apparent'] >= 512:
+            # Fixed VHD is raw data followed by footer
+            with open(filepath, 'rb') as f:
+                f.seek(-512, os.SEEK_END)
+                tail = f.read(512)
+            if tail[:8] == b'conectix':
+                probe_vhd(tail, filepath, info)
+    except (struct.error, IndexError, ValueError, OSError):
+        print('Can not parse {0} header of {1}, assuming raw image'.format(
+                info['format'], filepath))
+        info.update(format='raw', virtual_size=None, cluster_size=None,
+                backing=None)
+    if info['virtual_size'] is None:
+        info['virtual_size'] = info['apparent']
+    # Zero blocks are worth looking for in raw data and in sparse files,
+    # images of other formats store only allocated clusters anyway
+    info['sparse'] = (info['format'] == 'raw' or
+            info['allocated'] < info['apparent'])
+    return info
 
-class Net:
-    """Contains network based procedures, provides method to obtain virtual
-    machine ip address from hypervisor arp cache.
-    Takes virtual machine name and libvirt connection object arguments
-    """
-    def __init__(self, conn):
-        self.conn = conn
 
-    def mac(self, machname):
-        """Return virtual machine MAC address"""
-        xe = ET.fromstring(self.conn.lookupByName(machname).XMLDesc(0))
-        for iface in xe.findall('.//devices/interface'):
-            mac = iface.find('mac').get('address')
-        return mac
+# Parse qcow2 header
+def probe_qcow2(head, info):
+    (backing_offset, backing_size, cluster_bits,
+            size) = struct.unpack_from('>QIIQ', head, 8)
+    info['format'] = 'qcow2'
+    info['virtual_size'] = size
+    info['cluster_size'] = 1 << cluster_bits
+    if backing_offset and backing_offset + backing_size <= len(head):
+        info['backing'] = head[backing_offset:
+                backing_offset + backing_size].decode('utf-8', 'replace')
 
-    @staticmethod
-    def arp2ip(mac):
-        """Read arp cache and extracts ip address that corresponds virtual machine
-        MAC"""
-        f = open('/proc/net/arp', 'r')
-        for i in f.readlines():
-            if mac in i:
-                return i.split()[0]
-        f.close()
-        return None
 
-    def ifname(self, machname):
-        """Extract network interface name from domain XML decription"""
-        dom = self.conn.lookupByName(machname).XMLDesc(0)
-        net = ET.fromstring(dom).find('.//interface/source').get('network')
-        if not net:
-            return ET.fromstring(dom).find('.//interface/source').get('bridge')
-        ifname = ET.fromstring(
-                self.conn.networkLookupByName(net).XMLDesc(0)
-                            ).find('.//bridge').get('name')
-        return ifname
+# Parse vdi header
+def probe_vdi(head, info):
+    info['format'] = 'vdi'
+    size, block = struct.unpack_from('<QI', head, 0x170)
+    info['virtual_size'] = size
+    info['cluster_size'] = block
 
-    @staticmethod
-    def get_subnet(ifname):
-        """Return CIDR got from /bin/ip output"""
-        patt = re.compile(r'inet\s*(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}/\d{1,3})')
-        return patt.findall(os.popen('ip a s ' + ifname).read())[0]
 
-    @staticmethod
-    def long2ip(l):
-        """Convert a network byte order 32-bit integer to a dotted quad ip
-        address.
-        """
-        MAX_IP = 0xffffffff
-        MIN_IP = 0x0
-        if MAX_IP < l or l < MIN_IP:
-            raise TypeError(
-            "expected int between %d and %d inclusive" % (MIN_IP, MAX_IP))
-        return '%d.%d.%d.%d' % (l >> 24 & 255, l >> 16 & 255, l >> 8 & 255, l & 255)
+# Parse sparse vmdk header or text descriptor
+def probe_vmdk(head, info):
+    info['format'] = 'vmdk'
+    if head[:4] == b'KDMV':
+        capacity, grain, desc_offset, desc_size = struct.unpack_from(
+                '<QQQQ', head, 12)
+        info['virtual_size'] = capacity * 512
+        info['cluster_size'] = grain * 512
+        desc = head[desc_offset * 512:(desc_offset + desc_size) * 512]
+    else:
+        desc = head
+    desc = desc.split(b'\0', 1)[0].decode('utf-8', 'replace')
+    extents = re.findall(r'^\s*RW\s+(\d+)\s', desc, re.M)
+    if info['virtual_size'] is None and extents:
+        info['virtual_size'] = sum(int(e) for e in extents) * 512
+    parent = re.search(r'^\s*parentFileNameHint\s*=\s*"(.*)"', desc, re.M)
+    if parent:
+        info['backing'] = parent.group(1)
 
-    @staticmethod
-    def ip2long(ip):
-        """Convert a dotted-quad ip address to a network byte order 32-bit
-        integer.
-        :param ip: Dotted-quad ip address (eg. '127.0.0.1').
-        :type ip: str
-        :returns: Network byte order 32-bit integer or ``None`` if ip is invalid.
-        """
-        quads = ip.split('.')
-        if len(quads) == 1:
-            # only a network quad
-            quads = quads + [0, 0, 0]
-        elif len(quads) < 4:
-            # partial form, last supplied quad is host address, rest is network
-            host = quads[-1:]
-            quads = quads[:-1] + [0, ] * (4 - len(quads)) + host
-        lngip = 0
-        for q in quads:
-            lngip = (lngip << 8) | int(q)
-        return lngip
-
-    def cidr2block(self, cidr):
-        """Convert a CIDR notation ip address into a tuple containing the network
-        block start and end addresses.
-        """
-        ip, prefix = self.ip2long(cidr.split('/')[0]), int(cidr.split('/')[-1])
-        # keep left most prefix bits of ip
-        shift = 32 - prefix
-        block_start = ip >> shift << shift
-        # expand right most 32 - prefix bits to 1
-        mask = (1 << shift) - 1
-        block_end = block_start | mask
-        return (self.long2ip(block_start), self.long2ip(block_end))
 
-    @staticmethod
-    def block2range(start, end):
-        """Convert network block start and end address into a range of network
-        addresses
-        """
-        for j in range(1, 5):
-            globals()["oct" + str(j)] = [i for i in range(int(start.split('.')[j - 1]),
-                int(end.split('.')[j-1]) + 1)]
-        iprange = []
-        for i in oct1:
-            for j in oct2:
-                for m in oct3:
-                    for n in oct4:
-                        iprange.append(str(i)+'.'+str(j)+'.'+str(m)+'.'+str(n))
-        return iprange
-
-    def ip(self, machname):
-        """Get virtual machine ip address"""
-        ipaddr = self.arp2ip(self.mac(machname))
-        if ipaddr:
-            return ipaddr
-        pool = Pool(processes=128)
-        cidr = self.get_subnet(self.ifname(machname))
-        iprange = self.block2range(self.cidr2block(cidr)[0], self.cidr2block(cidr)[1])
-        pool.map(ping, iprange, 1)
-        pool.close()
-        pool.join()
-        return self.arp2ip(self.mac(machname))
-
-
-def ping(ip):
-    """Ping ip"""
-    if ip.split('.')[-1] != '0' and ip.split('.')[-1] != '255':
-        os.popen("ping -W1 -q -c1 " + ip + ' 2>/dev/null')
-        return 0
+# Parse vhd footer and dynamic disk header
+def probe_vhd(footer, filepath, info):
+    info['format'] = 'vpc'
+    data_offset, = struct.unpack_from('>Q', footer, 16)
+    size, = struct.unpack_from('>Q', footer, 48)
+    disk_type, = struct.unpack_from('>I', footer, 60)
+    info['virtual_size'] = size
+    if disk_type in (3, 4):
+        with open_image(filepath) as f:
+            header = f.read(data_offset + 1024)[data_offset:]
+        if header[:8] == b'cxsparse':
+            info['cluster_size'], = struct.unpack_from('>I', header, 32)
+            if disk_type == 4:
+                name = header[64:576].decode('utf-16-be', 'replace')
+                info['backing'] = name.split('\0', 1)[0] or None
 
 
-# Generate random MAC address
-def randomMAC():
-    mac = [0x00, 0x16, 0x3e,
-        random.randint(0x00, 0x7f),
-        random.randint(0x00, 0xff),
-        random.randint(0x00, 0xff)]
-    return ':'.join(map(lambda x: "%02x" % x, mac))
+# Parse vhdx region table and metadata region
+def probe_vhdx(filepath, info):
+    info['format'] = 'vhdx'
+    with open(filepath, 'rb') as f:
+        f.seek(192 * 1024)
+        regions = f.read(64 * 1024)
+        if regions[:4] != b'regi':
+            raise ValueError('bad region table')
+        count, = struct.unpack_from('<I', regions, 8)
+        for i in range(count):
+            guid, offset, length = struct.unpack_from('<16sQI', regions, 16 + i * 32)
+            if guid == VHDX_METADATA:
+                break
+        else:
+            raise ValueError('no metadata region')
+        f.seek(offset)
+        # Table of metadata items, items themselves follow at 64K or further
+        meta = f.read(64 * 1024)
+        if meta[:8] != b'metadata':
+            raise ValueError('bad metadata region')
+        count, = struct.unpack_from('<H', meta, 10)
+        for i in range(count):
+            guid, item, size = struct.unpack_from('<16sII', meta, 32 + i * 32)
+            if guid not in (VHDX_DISK_SIZE, VHDX_FILE_PARAMS):
+                continue
+            f.seek(offset + item)
+            data = f.read(8)
+            if guid == VHDX_DISK_SIZE:
+                info['virtual_size'], = struct.unpack('<Q', data)
+            else:
+                block, flags = struct.unpack('<II', data)
+                info['cluster_size'] = block
+                if flags & 2:
+                    # Parent locator is not parsed, path is not known
+                    info['backing'] = ''
 
 
-# Guess image type
-def find_image_format(filepath):
+# Return probe info of raw disk qcow2 image converts to while uploading,
+# unchanged info if image can not be converted
+def raw_view(filepath, info, deltas=None):
+    if image_codec(filepath):
+        print('Compressed qcow2 image can not be converted, uploading it as is')
+        return info
     try:
-        f = open(filepath).read(1024)
-    except:
-        return 'raw'
-    if 'QFI' in f:
-        return 'qcow2'
-    if 'Virtual Disk Image' in f:
-        return 'vdi'
-    if 'virtualHWVersion' in f:
-        return 'vmdk'
-    elif 'KDMV' == open(filepath).read(4):
-        return 'vmdk'
-    return 'raw'
+        Qcow2Image(open_source(filepath, deltas)).close()
+    except (ValueError, struct.error) as e:
+        print('{0}, uploading image as is'.format(e))
+        return info
+    size = info['virtual_size']
+    return dict(info, format='raw', apparent=size, allocated=size,
+            cluster_size=None, sparse=True, convert=True)
+
+
+# Return largest size image of format other than raw grows to when guest
+# writes all of its virtual disk: data clusters plus cluster tables
+def image_max_size(info):
+    cluster = info['cluster_size'] or 65536
+    clusters = -(-info['virtual_size'] // cluster)
+    # Per cluster map and reference count entries, header and top level tables
+    return (clusters * cluster + -(-clusters * 16 // cluster) * cluster +
+            16 * cluster)
 
 
 # Check if storage pool is LVM or dir
 def is_lvm(pool):
-    s = conn.storagePoolLookupByName(pool)
-    if ET.fromstring(s.XMLDesc(0)).get('type') == 'logical':
+    if state(conn).pool_xml(pool).get('type') == 'logical':
         return 1
     return 0
 
 
-# Get pool or volume name for given guest
-def get_stor(machname, pool=True):
+# Return index of volume path -> (pool name, volume name) of all volumes
+def stor_index():
+    index = {}
+    for p in conn.listAllStoragePools(libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE):
+        for v in p.listAllVolumes(0):
+            index[v.path()] = (p.name(), v.name())
+    return index
+
+
+# Return (pool name, volume name) of volume with given path, None if path
+# does not belong to any storage pool. Volume is looked up by path directly,
+# index of all volumes is built only if that fails and is reused afterwards
+def vol_by_path(path):
     try:
-        dom = conn.lookupByName(machname)
+        vol = conn.storageVolLookupByPath(path)
+        return vol.storagePoolLookupByVolume().name(), vol.name()
     except libvirt.libvirtError:
-        sys.exit(1)
-    xe = ET.fromstring(dom.XMLDesc(0))
-    try:
-        path = xe.find('.//devices/disk/source').get('file')
-    except AttributeError:
-        return None
-    if not path:
-        path = xe.find('.//devices/disk/source').get('dev')
-    if pool:
-        path = '/'.join(path.split('/')[:-1])
-        data = conn.listStoragePools()
-    else:
-        data = {i: conn.storagePoolLookupByName(i).listVolumes() for i in conn.listStoragePools()}
-    if isinstance(data, list):
-        for p in data:
-            o = conn.storagePoolLookupByName(p)
-            if ET.fromstring(o.XMLDesc(0)).find('.//path').text == path:
-                return p
-    else:
-        for i in data.items():
-            for v in i[1]:
-                o = conn.storagePoolLookupByName(i[0]).storageVolLookupByName(v)
-                if ET.fromstring(o.XMLDesc(0)).find('.//path').text == path:
-                    return v
-    return None
+        pass
+    return state(conn).get(('volume', None, 'index'), stor_index).get(path)
+
 
+# Return list of disk sources from domain XML description in order of disks,
+# either path or (pool name, volume name) for volume disks. Cdroms are skipped
+def disk_sources(xmldesc):
+    sources = []
+    for disk in ET.fromstring(xmldesc).findall('.//devices/disk'):
+        source = disk.find('source')
+        if disk.get('device', 'disk') != 'disk' or source is None:
+            continue
+        if source.get('pool') and source.get('volume'):
+            sources.append((source.get('pool'), source.get('volume')))
+        elif source.get('file') or source.get('dev'):
+            sources.append(source.get('file') or source.get('dev'))
+    return sources
 
-# Return list of volumes for specified virtual machine
-def get_vol(machname):
+
+# Return list of (pool name, volume name) for disks of given guest in order
+# of domain XML, disks outside of storage pools are skipped
+def get_stor(machname):
     try:
-        dom = conn.lookupByName(machname)
+        xmldesc = state(conn).domain_xml(machname)
     except libvirt.libvirtError:
         sys.exit(1)
-    xe = ET.fromstring(dom.XMLDesc(0))
-    return [vol.items()[0][1].split('/')[-1] for vol in xe.findall('.//devices/disk/source')]
+    stor = []
+    for src in disk_sources(xmldesc):
+        if isinstance(src, tuple):
+            stor.append(src)
+            continue
+        vol = vol_by_path(src)
+        if vol:
+            stor.append(vol)
+    return stor
 
 
-# Prepare template to import with virsh
-def prepare_tmpl(machname, mac, cpu, mem, img, format, dtype, net, type='kvm'):
-    if net == 'default':
-        ntype = 'network'
-    else:
-        ntype = 'bridge'
+# Collect domains, storage pools and volumes in one pass each and join
+# volumes with domains using them by path. Return list of
+# (pool name, pool info, [(volume name, volume info, domain name), ...])
+def inventory():
+    used = {}
+    for dom in conn.listAllDomains(0):
+        for src in disk_sources(dom.XMLDesc(0)):
+            used[src] = dom.name()
+    pools = []
+    for p in conn.listAllStoragePools(libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE):
+        vols = []
+        for v in p.listAllVolumes(0):
+            user = used.get(v.path()) or used.get((p.name(), v.name()))
+            vols.append((v.name(), v.info(), user))
+        pools.append((p.name(), p.info(), sorted(vols)))
+    return sorted(pools)
+
+
+# Return list of (name, active, vcpus, max memory KiB, current memory KiB,
+# autostart) for every domain. Data comes from one bulk stats call and one
+# listing of autostarted domains instead of several calls per domain
+def domain_stats():
+    autostart = set(d.name() for d in conn.listAllDomains(
+            libvirt.VIR_CONNECT_LIST_DOMAINS_AUTOSTART))
+    try:
+        stats = conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE |
+                libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BALLOON, 0)
+    except libvirt.libvirtError:
+        # Driver has no bulk stats, every domain is asked on its own
+        stats = [(dom, {}) for dom in conn.listAllDomains(0)]
+    domains = []
+    for dom, st in stats:
+        if 'vcpu.current' in st and 'balloon.maximum' in st:
+            dstate = st['state.state']
+            vcpus = st['vcpu.current']
+            maxmem = st['balloon.maximum']
+            curmem = st.get('balloon.current', maxmem)
+        else:
+            # Driver does not report everything in bulk stats
+            dstate, maxmem, curmem, vcpus = dom.info()[:4]
+        active = dstate not in (libvirt.VIR_DOMAIN_SHUTOFF, libvirt.VIR_DOMAIN_CRASHED)
+        domains.append((dom.name(), active, vcpus, maxmem, curmem,
+                dom.name() in autostart))
+    return domains
+
+
+# Prepare template to import with virsh, nics is list of (MAC, network)
+# of interfaces
+def prepare_tmpl(machname, nics, cpu, mem, img, format, dtype, type='kvm'):
     if type == 'kvm':
         if dtype == 'file':
             dsrc = 'file'
@@ -404,12 +2740,19 @@ def prepare_tmpl(machname, mac, cpu, mem, img, format, dtype, net, type='kvm'):
     xml_os = ET.SubElement(xml_root, 'os')
     xml_type = ET.SubElement(xml_os, 'type')
     xml_devices = ET.SubElement(xml_root, 'devices')
-    xml_interface = ET.SubElement(xml_devices, 'interface')
-    xml_interface.set('type', ntype)
-    xml_mac = ET.SubElement(xml_interface, 'mac')
-    xml_mac.set('address', mac)
-    xml_source = ET.SubElement(xml_interface, 'source')
-    xml_source.set(ntype, net)
+    xml_interfaces = []
+    for mac, net in nics:
+        if net == 'default':
+            ntype = 'network'
+        else:
+            ntype = 'bridge'
+        xml_interface = ET.SubElement(xml_devices, 'interface')
+        xml_interface.set('type', ntype)
+        xml_mac = ET.SubElement(xml_interface, 'mac')
+        xml_mac.set('address', mac)
+        xml_source = ET.SubElement(xml_interface, 'source')
+        xml_source.set(ntype, net)
+        xml_interfaces.append(xml_interface)
     xml_console = ET.SubElement(xml_devices, 'console')
     xml_console.set('type', 'pty')
     xml_cs_target = ET.SubElement(xml_console, 'target')
@@ -422,8 +2765,9 @@ def prepare_tmpl(machname, mac, cpu, mem, img, format, dtype, net, type='kvm'):
         xml_type.text = 'hvm'
         xml_boot = ET.SubElement(xml_os, 'boot')
         xml_boot.set('dev', 'hd')
-        xml_model = ET.SubElement(xml_interface, 'model')
-        xml_model.set('type', 'virtio')
+        for xml_interface in xml_interfaces:
+            xml_model = ET.SubElement(xml_interface, 'model')
+            xml_model.set('type', 'virtio')
         xml_features = ET.SubElement(xml_root, 'features')
         xml_acpi = ET.SubElement(xml_features, 'acpi')
         xml_apic = ET.SubElement(xml_features, 'apic')
@@ -473,7 +2817,8 @@ def prepare_tmpl(machname, mac, cpu, mem, img, format, dtype, net, type='kvm'):
     return ET.tostring(xml_root, encoding="unicode")
 
 
-# Return modified xml from imported file ready for defining guest
+# Return modified xml from imported file ready for defining guest. First
+# interface gets given MAC address, the rest get unused ones
 def xml2tmpl(xmlf, machname, image=None, format=None, dtype=None, mac=None):
     xe = ET.fromstring(xmlf)
     # Remove values that may cause error
@@ -483,6 +2828,13 @@ def xml2tmpl(xmlf, machname, image=None, format=None, dtype=None, mac=None):
         xe.find('.//devices').remove(xe.find('.//devices/emulator'))
     except:
         pass
+    # Reservations belong to machine XML was exported from
+    meta = xe.find('metadata')
+    if meta is not None:
+        for res in meta.findall('{%s}reservations' % META_NS):
+            meta.remove(res)
+        if not len(meta):
+            xe.remove(meta)
     # Replacing values
     xe.find('.//name').text = machname
     if image:
@@ -493,18 +2845,209 @@ def xml2tmpl(xmlf, machname, image=None, format=None, dtype=None, mac=None):
             stype = 'dev'
         xe.find('.//devices/disk/driver').set('type', format)
         xe.find('.//devices/disk/source').set(stype, image)
-    if mac:
-        xe.find('.//devices/interface/mac').set('address', mac)
+    for i, iface in enumerate(xe.findall('.//devices/interface')):
+        xml_mac = iface.find('mac')
+        if xml_mac is None:
+            xml_mac = ET.Element('mac')
+            iface.insert(0, xml_mac)
+        xml_mac.set('address', mac if i == 0 and mac else allocate_mac())
     return ET.tostring(xe, encoding="unicode")
 
 
+# Return asynchronous I/O mode of disks supported by hypervisor host:
+# io_uring needs libvirt 6.3 and QEMU 5.0, native AIO is used otherwise
+def disk_io_mode():
+    try:
+        if conn.getLibVersion() >= 6003000 and conn.getVersion() >= 5000000:
+            return 'io_uring'
+    except libvirt.libvirtError:
+        pass
+    return 'native'
+
+
+# Return type of storage pool holding disk source, None if it is not in pool
+def disk_pool_type(src):
+    vol = src if isinstance(src, tuple) else vol_by_path(src)
+    if not vol:
+        return None
+    try:
+        return state(conn).pool_xml(vol[0]).get('type')
+    except libvirt.libvirtError:
+        return None
+
+
+# Tune disks of domain XML with preset: blk keeps virtio-blk disks, scsi
+# moves them to virtio-scsi controller, auto picks scsi for guests with at
+# least SCSI_DISKS disks. Disks get dedicated iothread and queue per vCPU,
+# host native or io_uring I/O without host cache, and discard with zero
+# detection when they live in thin pool. Return modified XML
+def tune_disks(xmldesc, preset):
+    xe = ET.fromstring(xmldesc)
+    if xe.get('type') == 'lxc':
+        return xmldesc
+    devices = xe.find('./devices')
+    disks = [d for d in devices.findall('./disk') if d.get('device', 'disk') == 'disk']
+    if not disks:
+        return xmldesc
+    if preset == 'auto':
+        preset = 'scsi' if len(disks) >= SCSI_DISKS else 'blk'
+    queues = xe.find('./vcpu').text.strip()
+    iothreads = xe.find('./iothreads')
+    if iothreads is None:
+        iothreads = ET.Element('iothreads')
+        iothreads.text = '1'
+        xe.insert(list(xe).index(xe.find('./vcpu')) + 1, iothreads)
+    io = disk_io_mode()
+    # Disks moved to other bus get first names of its prefix not used by
+    # any other disk or cdrom
+    bus, prefix = ('scsi', 'sd') if preset == 'scsi' else ('virtio', 'vd')
+    moved = [d for d in disks if d.find('./target').get('bus') != bus]
+    used = set(d.find('./target').get('dev') for d in devices.findall('./disk')
+               if d.find('./target') is not None and
+               not any(d is m for m in moved))
+    if preset == 'scsi':
+        controller = None
+        for c in devices.findall('./controller[@type="scsi"]'):
+            if c.get('model') == 'virtio-scsi':
+                controller = c
+            else:
+                devices.remove(c)
+        if controller is None:
+            controller = ET.SubElement(devices, 'controller', type='scsi',
+                                       index='0', model='virtio-scsi')
+        driver = controller.find('./driver')
+        if driver is None:
+            driver = ET.SubElement(controller, 'driver')
+        driver.set('iothread', '1')
+        driver.set('queues', queues)
+    for disk in disks:
+        driver = disk.find('./driver')
+        if driver is None:
+            driver = ET.SubElement(disk, 'driver', name='qemu')
+        driver.set('cache', 'none')
+        driver.set('io', io)
+        source = disk.find('./source')
+        src = None
+        if source is not None:
+            if source.get('pool') and source.get('volume'):
+                src = (source.get('pool'), source.get('volume'))
+            else:
+                src = source.get('file') or source.get('dev')
+        ptype = disk_pool_type(src) if src else None
+        if ptype in THIN_POOLS or (ptype is None and disk.get('type') == 'file'):
+            driver.set('discard', 'unmap')
+            driver.set('detect_zeroes', 'unmap')
+        if any(disk is m for m in moved):
+            i = 0
+            while disk_target(prefix, i) in used:
+                i += 1
+            used.add(disk_target(prefix, i))
+            target = disk.find('./target')
+            target.set('bus', bus)
+            target.set('dev', disk_target(prefix, i))
+            address = disk.find('./address')
+            if address is not None:
+                disk.remove(address)
+        if preset == 'scsi':
+            # Queues and iothread of scsi disks are set on controller
+            driver.attrib.pop('iothread', None)
+            driver.attrib.pop('queues', None)
+        else:
+            driver.set('iothread', '1')
+            driver.set('queues', queues)
+    return ET.tostring(xe, encoding='unicode')
+
+
+# Return target device name of disk with given index after prefix, names
+# run like vda..vdz, vdaa..vdaz, vdba
+def disk_target(prefix, index):
+    name = ''
+    index += 1
+    while index:
+        index, r = divmod(index - 1, 26)
+        name = chr(ord('a') + r) + name
+    return prefix + name
+
+
+# Return list of (MAC, network) for interfaces of new machine: first one
+# gets given MAC, the rest get unused ones
+def nics(args, mac):
+    nets = args.net or ['default']
+    return [(mac, nets[0])] + [(allocate_mac(), net) for net in nets[1:]]
+
+
+# Return list of (element, setting, value) of vhost offload settings given
+# as comma separated setting=on|off, setting is prefixed with guest. for
+# offloads of guest and optionally with host. for offloads of host
+def offload_settings(arg):
+    settings = []
+    if not arg:
+        return settings
+    for item in arg.split(','):
+        key, _, value = item.strip().partition('=')
+        elem, _, name = key.rpartition('.')
+        elem = elem or 'host'
+        if elem not in NET_OFFLOADS or name not in NET_OFFLOADS[elem] or \
+                value not in ('on', 'off'):
+            print('Error! Offload setting can be host.<name>=on|off or '
+                  'guest.<name>=on|off, names: host {0}, guest {1}'.format(
+                  ' '.join(NET_OFFLOADS['host']), ' '.join(NET_OFFLOADS['guest'])))
+            sys.exit(1)
+        settings.append((elem, name, value))
+    return settings
+
+
+# Tune virtio interfaces of domain XML for vhost: queues per interface,
+# one per vCPU unless given, rx and tx ring size and offload settings as
+# returned by offload_settings. Return modified XML
+def tune_nics(xmldesc, queues=None, ring=None, offload=()):
+    if ring and ring not in NET_RINGS:
+        print('Error! Ring size can be {0}'.format(', '.join(map(str, NET_RINGS))))
+        sys.exit(1)
+    xe = ET.fromstring(xmldesc)
+    if xe.get('type') == 'lxc':
+        return xmldesc
+    queues = queues or int(xe.find('./vcpu').text)
+    for iface in xe.findall('./devices/interface'):
+        model = iface.find('./model')
+        if model is None or model.get('type') != 'virtio':
+            continue
+        driver = iface.find('./driver')
+        if driver is None:
+            driver = ET.SubElement(iface, 'driver')
+        driver.set('name', 'vhost')
+        if queues > 1:
+            driver.set('queues', str(queues))
+        else:
+            driver.attrib.pop('queues', None)
+        if ring:
+            # QEMU keeps tx ring at 256 unless backend is vhost-user
+            driver.set('rx_queue_size', str(ring))
+            driver.set('tx_queue_size', str(ring))
+        for elem, name, value in offload:
+            sub = driver.find('./' + elem)
+            if sub is None:
+                sub = ET.SubElement(driver, elem)
+            sub.set(name, value)
+    return ET.tostring(xe, encoding='unicode')
+
+
+# Return hash algorithm chosen by option, None if digest is disabled
+def digest_algo(arg):
+    if arg == 'none':
+        return None
+    return arg
+
+
 def argcheck(arg):
-    if arg[-1].lower() == 'm':
+    if arg[-1].lower() == 'k':
+        return int(arg[:-1])
+    elif arg[-1].lower() == 'm':
         return int(arg[:-1]) * 1024
     elif arg[-1].lower() == 'g':
         return int(arg[:-1]) * (1024 ** 2)
     else:
-        print('Error! Format can be <int>M or <int>G')
+        print('Error! Format can be <int>K, <int>M or <int>G')
         sys.exit(1)
 
 
@@ -522,51 +3065,24 @@ def lsvirt(storage, volumes):
         sys.exit(0)
     # List volumes
     if volumes:
-        # Find list of machines and create dict with list of vols associated to them
-        ml = [conn.lookupByID(i).name() for i in conn.listDomainsID()] + conn.listDefinedDomains()
         print('{0:<15}{1:<30}{2:<10}{3:<10}{4:<10}'.format('Pool', 'Volume', 'Size',
                 'Use', 'Used by'))
-        for p in pools:
-            vols = conn.storagePoolLookupByName(p).listVolumes()
-            vol_dict = {}
-            for mach in ml:
-                associated_vols = get_vol(mach)
-                if associated_vols:
-                    for v in associated_vols:
-                        vol_dict[v] = mach
-            pinf = conn.storagePoolLookupByName(p).info()
+        for p, pinf, vols in inventory():
             print(p)
             print('{0:>15}'.format('\\'))
-            for v in sorted(vols):
-                if v not in vol_dict:
-                    vol_dict[v] = None
-                vinf = conn.storagePoolLookupByName(p).storageVolLookupByName(v).info()
+            for v, vinf, user in vols:
                 use = '{0:.2%}'.format(float(vinf[2]) / float(pinf[1]))
                 print('{0:<15}{1:<30}{2:<10}{3:<10}{4:<10}'.format(' ', v,
-                        convert_bytes(vinf[2]), use, vol_dict[v]))
+                        convert_bytes(vinf[2]), use, user))
         sys.exit(0)
-    # List machines
-    vsorted = [conn.lookupByID(i).name() for i in conn.listDomainsID()]
-    # Function to return basic domain info
-    def dinfo(domain):
-        d = conn.lookupByName(domain)
-        j = d.info()
-        if d.autostart():
-            a = 'on'
-        else:
-            a = 'off'
-        if d.isActive():
-            state = 'up'
-        else:
-            state = 'down'
-        print('{0:<30}{1:<10}{2:<10}{3:<10}{4:>5}'.format(i, j[3],
-            convert_bytes(j[1] * 1024), state, a))
+    # List machines, running ones first
     print('{0:<30}{1:<10}{2:<10}{3:<10}{4:>5}'.format('Name', 'CPUs', 'Memory',
             'State', 'Autostart'))
-    for i in sorted(vsorted):
-        dinfo(i)
-    for i in sorted(conn.listDefinedDomains()):
-        dinfo(i)
+    for name, active, vcpus, maxmem, curmem, auto in sorted(domain_stats(),
+            key=lambda d: (not d[1], d[0])):
+        print('{0:<30}{1:<10}{2:<10}{3:<10}{4:>5}'.format(name, vcpus,
+            convert_bytes(maxmem * 1024), 'up' if active else 'down',
+            'on' if auto else 'off'))
     sys.exit(0)
 
 
@@ -608,6 +3124,484 @@ def uri_lxc(uri):
     return False
 
 
+# Import virtual machine described by parsed command line arguments
+def import_vm(args):
+    if not args.xml and not args.image and not args.linked:
+        print('Either -xml, -i or --linked should be specified')
+        sys.exit(1)
+    mem = argcheck(args.mem)
+    chunk = argcheck(args.chunk) * 1024
+    if not args.mac and not args.xml:
+        mac = allocate_mac()
+    elif not is_mac_addr(args.mac):
+        print('Incorrect mac address: {0}'.format(args.mac))
+        sys.exit(1)
+    else:
+        mac = args.mac
+    if args.xml and not args.image and not args.linked:
+        upload = False
+        template = xml2tmpl(args.xml.read(), args.name, mac=mac)
+    else:
+        # LXC
+        if uri_lxc(args.uri):
+            upload = False
+            if not os.path.isdir(args.image):
+                if not args.xml:
+                    print('No image and xml specified')
+                    sys.exit(1)
+            elif not args.xml:
+                template = prepare_tmpl(args.name, nics(args, mac), args.cpus,
+                                        mem, args.image, '', '', 'lxc')
+            else:
+                template = xml2tmpl(args.xml.read(), args.name, args.image,
+                                    'format', 'mount', mac)
+        elif args.linked:   # QEMU linked clone of template
+            if is_lvm(args.pool):
+                print('Linked clones are supported only in directory pools')
+                sys.exit(1)
+            upload = False
+            format = 'qcow2'
+            dtype = 'file'
+            image = Disk(conn, args.pool).create_linked_vol(args.name, args.linked)
+            if args.xml:
+                template = xml2tmpl(args.xml.read(), args.name, image, format, dtype, mac)
+            else:
+                template = prepare_tmpl(args.name, nics(args, mac), args.cpus,
+                                        mem, image, format, dtype, 'kvm')
+        else:   # QEMU
+            if not os.path.isfile(args.image):
+                print('{0} not found'.format(args.image))
+                sys.exit(1)
+            if args.deltas and args.cache:
+                print('Image rebuilt from delta exports can not be cached')
+                sys.exit(1)
+            for d in args.deltas or []:
+                if not os.path.isfile(d):
+                    print('{0} not found'.format(d))
+                    sys.exit(1)
+            info = probe_image(args.image, args.deltas)
+            if info['backing'] is not None:
+                print('{0} is overlay of {1}, import it flattened'.format(
+                        args.image, info['backing'] or 'parent image'))
+                sys.exit(1)
+            # Block pools get native raw disks, qcow2 image is converted
+            # while it is uploaded
+            if info['format'] == 'qcow2' and is_lvm(args.cache or args.pool):
+                info = raw_view(args.image, info, args.deltas)
+            format = info['format']
+            upload = True
+            # Volume of interrupted import is reused on resume
+            vol = args.resume and Disk(conn, args.pool).find_vol(args.name)
+            if vol:
+                image = vol.path()
+            elif args.cache:
+                # Upload only what is not cached, clone the rest on hypervisor
+                upload = False
+                cache = Cache(conn, args.cache)
+                # Image shared by parallel imports is hashed and cached once
+                with cache_slots(os.path.abspath(args.image)):
+                    key = cache.digest(args.image)
+                with cache_slots(key):
+                    if not cache.find(key):
+                        with upload_slots(args.cache):
+                            if not cache.add(key, args.image, info, chunk,
+                                    digest_algo(args.hash)):
+                                print('Upload failed. Exiting')
+                                sys.exit(1)
+                    # Cached volume is not replaced while it is cloned
+                    image = cache.clone(key, args.name, args.pool)
+                if args.cache_size:
+                    for v in cache.prune(argcheck(args.cache_size) * 1024):
+                        print('Cached volume {0} removed'.format(v))
+            else:
+                image = Disk(conn, args.pool).create_image_vol(args.name, info)
+            if is_lvm(args.pool):
+                dtype = 'block'
+            else:
+                dtype = 'file'
+            if args.xml:
+                template = xml2tmpl(args.xml.read(), args.name, image, format, dtype, mac)
+            elif not args.xml:
+                template = prepare_tmpl(args.name, nics(args, mac), args.cpus,
+                                        mem, image, format, dtype, 'kvm')
+    if args.disk_tune:
+        template = tune_disks(template, args.disk_tune)
+    if args.net_tune or args.net_queues or args.net_ring or args.net_offload:
+        template = tune_nics(template, args.net_queues, args.net_ring,
+                             offload_settings(args.net_offload))
+    try:
+        if args.resume and args.name in conn.listDefinedDomains():
+            print('{0} already imported'.format(args.name))
+        else:
+            define_domain(template, args.name, args.reserve_ip,
+                    args.perf_profile, args.hugepages)
+            print('{0} imported'.format(args.name))
+    except libvirt.libvirtError:
+        sys.exit(1)
+    if upload:
+        with upload_slots(args.pool):
+            ret = Disk(conn, args.pool, chunk).upload_vol(args.name, args.image,
+                    sparse=info['sparse'], size=info['apparent'],
+                    resume=args.resume, algo=digest_algo(args.hash),
+                    convert=info['convert'], deltas=args.deltas)
+        if not ret:
+            print('Upload failed. Exiting')
+            sys.exit(1)
+
+
+# Create virtual machine described by parsed command line arguments
+def create_vm(args):
+    mem = argcheck(args.mem)
+    if not args.mac:
+        mac = allocate_mac()
+    elif not is_mac_addr(args.mac):
+        print('Incorrect mac address: {0}'.format(args.mac))
+        sys.exit(1)
+    else:
+        mac = args.mac
+    format = args.dformat
+    imgsize = argcheck(args.size) * 1024
+    args.image = args.name
+    if is_lvm(args.pool):
+        dtype = 'block'
+    else:
+        dtype = 'file'
+    image = Disk(conn, args.pool).create_vol(args.name, imgsize, format)
+    template = prepare_tmpl(args.name, nics(args, mac), args.cpus, mem, image,
+        format, dtype)
+    if args.disk_tune:
+        template = tune_disks(template, args.disk_tune)
+    if args.net_tune or args.net_queues or args.net_ring or args.net_offload:
+        template = tune_nics(template, args.net_queues, args.net_ring,
+                             offload_settings(args.net_offload))
+    define_domain(template, args.name, args.reserve_ip, args.perf_profile,
+            args.hugepages)
+    print('{0} created'.format(args.name))
+
+
+# Expand {01..50} ranges and {a,b} lists in virtual machine name,
+# width of zero padded range bounds is kept
+def expand_names(pattern):
+    m = re.search(r'\{([^{}]*)\}', pattern)
+    if not m:
+        return [pattern]
+    head, tail = pattern[:m.start()], pattern[m.end():]
+    r = re.match(r'^(\d+)\.\.(\d+)$', m.group(1))
+    if r:
+        first, last = r.groups()
+        width = len(first) if first.startswith('0') else 0
+        step = 1 if int(last) >= int(first) else -1
+        items = ['{0:0{1}d}'.format(i, width)
+                 for i in range(int(first), int(last) + step, step)]
+    else:
+        items = m.group(1).split(',')
+    return [head + i + rest for i in items for rest in expand_names(tail)]
+
+
+# Return list of argument namespaces, one per virtual machine named on
+# command line or listed in manifest file. Manifest line is names or
+# patterns followed by options of subcommand overriding command line ones
+def bulk_args(args, subparser):
+    xml = args.xml.read() if getattr(args, 'xml', None) else None
+    lines = [(name, []) for name in args.names]
+    if args.manifest:
+        try:
+            with open(args.manifest) as f:
+                for line in f:
+                    words = shlex.split(line, comments=True)
+                    if words:
+                        lines.append((None, words))
+        except (IOError, ValueError) as e:
+            print(e)
+            sys.exit(1)
+    # Options given several times are replaced by manifest, not extended
+    appends = [a.dest for a in subparser._actions
+               if isinstance(a, argparse._AppendAction)]
+    vms = []
+    for name, words in lines:
+        vm = argparse.Namespace(**vars(args))
+        names = [name]
+        if words:
+            for dest in appends:
+                setattr(vm, dest, None)
+            vm = subparser.parse_args(words, namespace=vm)
+            for dest in appends:
+                if getattr(vm, dest) is None:
+                    setattr(vm, dest, getattr(args, dest))
+            names = vm.names
+            vm.names = []
+        for n in [n for pattern in names for n in expand_names(pattern)]:
+            one = argparse.Namespace(**vars(vm))
+            one.name = n
+            if xml is not None:
+                one.xml = io.StringIO(xml)
+            vms.append(one)
+    if not vms:
+        print('No virtual machine name specified')
+        sys.exit(1)
+    names = [vm.name for vm in vms]
+    if len(set(names)) != len(names):
+        print('Virtual machine names are not unique')
+        sys.exit(1)
+    macs = [vm.mac for vm in vms if vm.mac]
+    if len(set(macs)) != len(macs):
+        print('MAC address can not be shared by several virtual machines')
+        sys.exit(1)
+    return vms
+
+
+class Slots:
+    """Semaphores created on demand by name, each lets limited amount of
+    threads in at once. Limit 0 means no limit.
+    Takes limit as argument
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.slots = {}
+
+    def __call__(self, name):
+        """Return context manager holding slot of given name"""
+        if not self.limit:
+            return contextlib.nullcontext()
+        with self.lock:
+            if name not in self.slots:
+                self.slots[name] = threading.Semaphore(self.limit)
+            return self.slots[name]
+
+
+# Concurrent uploads into one storage pool and concurrent fills of one cache
+# entry in bulk provisioning
+upload_slots = Slots(0)
+cache_slots = Slots(1)
+
+
+class ThreadOutput:
+    """Standard output replacement for worker threads, lines written by
+    thread are prefixed with name it is registered with and the last one is
+    kept. Threads not registered write through.
+    Takes original output as argument
+    """
+    def __init__(self, out):
+        self.out = out
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def register(self, name):
+        self.local.name = name
+        self.local.buf = ''
+        self.local.last = ''
+
+    def last(self):
+        return self.local.last
+
+    def write(self, text):
+        name = getattr(self.local, 'name', None)
+        if name is None:
+            return self.out.write(text)
+        self.local.buf += text
+        *lines, self.local.buf = self.local.buf.split('\n')
+        for line in lines:
+            if line.strip():
+                self.local.last = line.strip()
+                with self.lock:
+                    self.out.write('[{0}] {1}\n'.format(name, line))
+        return len(text)
+
+    def flush(self):
+        self.out.flush()
+
+
+# Provision virtual machines by calling func with each namespace of vms in
+# pool of worker threads sharing the connection, at most jobs at once and
+# at most pool_jobs of them transferring data into the same storage pool.
+# Return list of (name, succeeded, seconds, last message) in order of vms
+def provision(func, vms, jobs, pool_jobs):
+    upload_slots.limit = pool_jobs
+    Progress.quiet = True
+    out = ThreadOutput(sys.stdout)
+    results = [None] * len(vms)
+    todo = queue.Queue()
+    for i in range(len(vms)):
+        todo.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = todo.get_nowait()
+            except queue.Empty:
+                return
+            vm = vms[i]
+            out.register(vm.name)
+            start = time.time()
+            ok = True
+            try:
+                func(vm)
+            except SystemExit as e:
+                ok = not e.code
+            except Exception as e:
+                print(e)
+                ok = False
+            results[i] = (vm.name, ok, time.time() - start, out.last())
+    sys.stdout = out
+    try:
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for i in range(max(1, min(jobs, len(vms))))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.stdout = out.out
+    return results
+
+
+# Print hit and miss counters of inventory cache if asked
+def print_stats(args):
+    if args.stats:
+        st = state(conn)
+        sys.stderr.write('Inventory cache: {0} hits, {1} misses\n'.format(
+                st.hits, st.misses))
+
+
+# Connections of daemon by URI and thread running libvirt event loop for them
+daemon_conns = {}
+event_thread = None
+
+
+# Return open connection of daemon to URI, dead one is opened again
+def daemon_conn(uri):
+    c = daemon_conns.get(uri)
+    if c is not None:
+        try:
+            if c.isAlive():
+                return c
+        except libvirt.libvirtError:
+            pass
+    if c is not None:
+        # Inventory cache of dead connection goes with it
+        with states_lock:
+            st = states.pop(c, None)
+        if st:
+            st.close()
+    try:
+        c = libvirt.open(uri)
+    except libvirt.libvirtError:
+        sys.exit(1)
+    if not Net.is_local(uri):
+        # Dead remote connections are noticed and reopened
+        try:
+            c.setKeepAlive(5, 3)
+        except libvirt.libvirtError:
+            pass
+    daemon_conns[uri] = c
+    return c
+
+
+class SocketOutput:
+    """Output of command served by daemon, written text is sent to client
+    as JSON line tagged with file descriptor number.
+    Takes socket file object and descriptor number as arguments
+    """
+    def __init__(self, wfile, fd):
+        self.wfile = wfile
+        self.fd = fd
+
+    def write(self, text):
+        if text:
+            self.wfile.write(json.dumps({'fd': self.fd, 'data': text}).encode() + b'\n')
+        return len(text)
+
+    def flush(self):
+        self.wfile.flush()
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """Serves one command line sent by forward, run in directory of client
+    with connection kept open by daemon. Commands are served one at a time,
+    so long ones in LOCAL_COMMANDS and up --wait are left to client"""
+    def handle(self):
+        global conn, mac_index, host_index
+        try:
+            req = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        code = 0
+        out = SocketOutput(self.wfile, 1)
+        with contextlib.redirect_stdout(out), \
+                contextlib.redirect_stderr(SocketOutput(self.wfile, 2)):
+            # Machines might have been created since last command
+            mac_index = host_index = None
+            Progress.quiet = False
+            try:
+                os.chdir(req['cwd'])
+                args = parser.parse_args(req['argv'])
+                if args.sub in LOCAL_COMMANDS or args.sub == 'up' and \
+                        (args.wait or args.wait_for):
+                    code = None
+                else:
+                    conn = daemon_conn(args.uri)
+                    try:
+                        run(args)
+                    finally:
+                        print_stats(args)
+            except SystemExit as e:
+                if isinstance(e.code, str):
+                    print(e.code)
+                code = e.code if isinstance(e.code, int) else int(bool(e.code))
+            except Exception as e:
+                print(e)
+                code = 1
+        try:
+            out.flush()
+            reply = {'local': True} if code is None else {'code': code}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+        except OSError:
+            pass
+
+
+# Serve commands over Unix socket until interrupted, libvirt event loop
+# runs in background thread for connection keepalive and domain events
+def serve(path=DAEMON_SOCKET):
+    global event_thread
+
+    def loop():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    # Errors reported by libvirt go to client of failed command
+    libvirt.registerErrorHandler(
+            lambda ctx, err: sys.stderr.write('{0}\n'.format(err[2])), None)
+    event_thread = threading.Thread(target=loop, daemon=True)
+    event_thread.start()
+    if os.path.exists(path):
+        probe_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe_sock.connect(path)
+            print('Daemon is already running on {0}'.format(path))
+            sys.exit(1)
+        except OSError:
+            # Left by daemon which did not exit cleanly
+            os.remove(path)
+        finally:
+            probe_sock.close()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    old = os.umask(0o077)
+    try:
+        server = socketserver.UnixStreamServer(path, DaemonHandler)
+    finally:
+        os.umask(old)
+    print('Serving on {0}'.format(path))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
 # Functions to operate with terminal. Required for console option
 def reset_term():
     termios.tcsetattr(0, termios.TCSADRAIN, attrs)
@@ -637,6 +3631,10 @@ parser = argparse.ArgumentParser(prog='virtup.py')
 parser.add_argument('-c', '--connect', dest='uri', type=str, default='qemu:///system',
         help='hypervisor connection URI, default is qemu:///system')
 parser.add_argument('-v', '--version', action='version', version='%(prog)s 0.7')
+parser.add_argument('--local', action='store_true',
+        help='run command in this process even if daemon is running')
+parser.add_argument('--stats', action='store_true',
+        help='print hits and misses of inventory cache when command is done')
 subparsers = parser.add_subparsers(dest='sub')
 # Parent argparser to contain repeated arguments
 suparent = argparse.ArgumentParser(add_help=False)
@@ -644,8 +3642,9 @@ suparent.add_argument('name', type=str, help='virtual machine name')
 parent = argparse.ArgumentParser(add_help=False)
 parent.add_argument('-c', dest='cpus', type=int, default=1,
         help='amount of CPU cores, default is 1')
-parent.add_argument('-net', dest='net', metavar='IFACE', type=str, default='default',
-        help='bridge network interface name, default is NAT network "default"')
+parent.add_argument('-net', dest='net', metavar='IFACE', type=str, action='append',
+        help='bridge network interface name, default is NAT network "default", '
+             'repeat for several interfaces')
 parent.add_argument('-m', dest='mem', metavar='RAM', type=str, default='512M',
         help='amount of memory, can be M or G, default is 512M')
 parent.add_argument('-p', dest='pool', metavar='POOL', type=str,
@@ -653,22 +3652,93 @@ parent.add_argument('-p', dest='pool', metavar='POOL', type=str,
         help='storage pool name, default is "default"')
 parent.add_argument('-mac', dest='mac', metavar='MAC', type=str,
         help='MAC address in format 00:00:00:00:00:00')
+parent.add_argument('--reserve-ip', dest='reserve_ip', action='store_true',
+        help='reserve DHCP address in libvirt network, so ip is known at once')
+parent.add_argument('--perf-profile', dest='perf_profile', action='store_true',
+        help='pin vCPUs and emulator to free cores and memory to one NUMA node')
+parent.add_argument('--hugepages', action='store_true',
+        help='back memory with hugepages of NUMA node, implies --perf-profile')
+parent.add_argument('--disk-tune', dest='disk_tune', metavar='PRESET',
+        choices=['auto', 'blk', 'scsi'],
+        help='give disks iothread, queue per vCPU and I/O mode of host: blk, '
+             'scsi for virtio-scsi controller or auto picking one by disk count')
+parent.add_argument('--net-tune', dest='net_tune', action='store_true',
+        help='use vhost with queue per vCPU for virtio interfaces')
+parent.add_argument('--net-queues', dest='net_queues', metavar='N', type=int,
+        help='queues of virtio interfaces, implies --net-tune')
+parent.add_argument('--net-ring', dest='net_ring', metavar='SIZE', type=int,
+        help='rx and tx ring size of virtio interfaces: 256, 512 or 1024, '
+             'implies --net-tune')
+parent.add_argument('--net-offload', dest='net_offload', metavar='LIST', type=str,
+        help='vhost offloads like host.tso4=off,guest.csum=off, implies --net-tune')
+# Parent argparser of commands provisioning several machines at once
+bulk = argparse.ArgumentParser(add_help=False)
+bulk.add_argument('names', metavar='name', nargs='*', type=str,
+        help='virtual machine names, {01..50} ranges and {a,b} lists are expanded')
+bulk.add_argument('--manifest', dest='manifest', metavar='FILE', type=str,
+        help='file with machine name or pattern and its options per line')
+bulk.add_argument('-j', '--jobs', dest='jobs', metavar='N', type=int, default=4,
+        help='machines provisioned at once, default is 4')
+bulk.add_argument('--pool-jobs', dest='pool_jobs', metavar='N', type=int, default=2,
+        help='transfers into one storage pool at once, default is 2')
 box_auto = subparsers.add_parser('autostart', parents=[suparent],
         description='Set autostart flag for virtual machine',
         help='Set autostart flag')
 box_auto.add_argument('-set', dest='auto', choices=['on', 'off'], required=True,
         help='Flag can be on or off, required')
-box_add = subparsers.add_parser('import', parents=[parent, suparent],
+box_add = subparsers.add_parser('import', parents=[parent, bulk],
         description='Import virtual machine from image file or XML description',
         help='Import virtual machine from image/XML file')
 box_add.add_argument('-i', dest='image', type=str, metavar='IMAGE',
         help='template image file location')
 box_add.add_argument('-xml', dest='xml', type=argparse.FileType('r'),
         help='xml file, describing virtual machine to import')
+box_add.add_argument('--delta', dest='deltas', metavar='DELTA', action='append',
+        help='apply delta export over image, can be repeated for chain of deltas')
+box_add.add_argument('--linked', dest='linked', metavar='TEMPLATE', type=str,
+        help='create disk as thin qcow2 overlay of template volume from pool')
+box_add.add_argument('--cache', dest='cache', metavar='POOL', type=str,
+        help='keep uploaded image in cache pool and clone disk from it')
+box_add.add_argument('--cache-size', dest='cache_size', metavar='SIZE', type=str,
+        help='remove least recently used cached images above this size, can be M or G')
+box_add.add_argument('-bs', dest='chunk', metavar='SIZE', type=str, default='256K',
+        help='transfer block size, can be K or M, default is 256K')
+box_add.add_argument('--resume', action='store_true',
+        help='continue interrupted image upload')
+box_add.add_argument('-hash', dest='hash', choices=DIGESTS + ['none'],
+        default='blake2b',
+        help='hash algorithm of uploaded data digest, default is blake2b, '
+             'image manifest algorithm is used if it exists')
+box_tmpl = subparsers.add_parser('template',
+        description='Upload image into storage pool as template volume for linked clones',
+        help='Register template volume')
+box_tmpl.add_argument('name', type=str, help='template volume name')
+box_tmpl.add_argument('-i', dest='image', type=str, metavar='IMAGE', required=True,
+        help='template image file location')
+box_tmpl.add_argument('-p', dest='pool', metavar='POOL', type=str,
+        default='default',
+        help='storage pool name, default is "default"')
+box_tmpl.add_argument('-bs', dest='chunk', metavar='SIZE', type=str, default='256K',
+        help='transfer block size, can be K or M, default is 256K')
+box_tmpl.add_argument('-hash', dest='hash', choices=DIGESTS + ['none'],
+        default='blake2b',
+        help='hash algorithm of uploaded data digest, default is blake2b, '
+             'image manifest algorithm is used if it exists')
+box_cache = subparsers.add_parser('cache', help='Manage template cache',
+        description='List or prune template images cached by import --cache')
+box_cache.add_argument('action', choices=['ls', 'prune'],
+        help='list cached images or remove least recently used ones')
+box_cache.add_argument('-p', dest='pool', metavar='POOL', type=str,
+        default='default',
+        help='cache storage pool name, default is "default"')
+box_cache.add_argument('-s', dest='size', metavar='SIZE', type=str,
+        help='prune until cache fits size, can be M or G')
+box_cache.add_argument('-d', dest='days', metavar='DAYS', type=int,
+        help='prune images not used for given amount of days')
 console = subparsers.add_parser('console', parents=[suparent],
         description='Connect to virtual machine\'s console',
         help='Connect to console')
-box_create = subparsers.add_parser('create', parents=[parent, suparent],
+box_create = subparsers.add_parser('create', parents=[parent, bulk],
         description='Create virtual machine from scratch',
         help='Create virtual machine')
 box_create.add_argument('-s', dest='size', type=str, default='8G',
@@ -683,6 +3753,17 @@ box_export.add_argument('-xml', dest='xml', action='store_true',
         help='virtual machine XML description will be printed')
 box_export.add_argument('-i', dest='image', type=str,
         help='image file name to export disk image')
+box_export.add_argument('-bs', dest='chunk', metavar='SIZE', type=str, default='256K',
+        help='transfer block size, can be K or M, default is 256K')
+box_export.add_argument('--resume', action='store_true',
+        help='continue interrupted disk image download')
+box_export.add_argument('-hash', dest='hash', choices=DIGESTS + ['none'],
+        default='blake2b',
+        help='hash algorithm of image manifest, default is blake2b')
+box_export.add_argument('--blockmap', action='store_true',
+        help='save block map next to image for later incremental exports')
+box_export.add_argument('--since', dest='since', metavar='PREV', type=str,
+        help='export only blocks changed since previous export PREV into delta file')
 box_ls = subparsers.add_parser('ls', help='List virtual machines',
         description='List existing virtual machines, active storage pools, ip addresses')
 box_ls.add_argument('-i', dest='info', action='store_true',
@@ -699,10 +3780,20 @@ box_rm = subparsers.add_parser('rm', parents=[suparent],
         description='Remove virtual machine',
         help='Remove virtual machine')
 box_rm.add_argument('--full', action='store_true',
-        help='remove machine with image assigned to it')
-box_start = subparsers.add_parser('up', parents=[suparent],
+        help='remove machine with images assigned to it')
+box_start = subparsers.add_parser('up',
         description='Start virtual machine',
         help='Start virtual machine')
+box_start.add_argument('names', metavar='name', nargs='+', type=str,
+        help='virtual machine names, {01..50} ranges and {a,b} lists are expanded')
+box_start.add_argument('--wait', dest='wait', action='store_true',
+        help='wait until machines boot')
+box_start.add_argument('--wait-for', dest='wait_for', choices=['ip', 'agent', 'ssh'],
+        help='wait until machine has ip address, guest agent connected or '
+             'ssh port open, default is ip, implies --wait')
+box_start.add_argument('--timeout', dest='timeout', metavar='SEC', type=int,
+        default=WAIT_TIMEOUT,
+        help='seconds to wait, default is {0}'.format(WAIT_TIMEOUT))
 box_stop = subparsers.add_parser('down', parents=[suparent],
         description='Power off virtual machine',
         help='Power off virtual machine')
@@ -730,25 +3821,17 @@ action.add_argument('--add', action='store_true',
         help='create virtual volume')
 action.add_argument('--del', action='store_true',
         help='remove virtual volume')
+box_daemon = subparsers.add_parser('daemon', help='Serve commands over local socket',
+        description='Keep hypervisor connections open and serve commands of '
+                    'other virtup.py invocations over Unix socket {0}, '
+                    'path can be changed with VIRTUP_SOCKET'.format(DAEMON_SOCKET))
 help_c = subparsers.add_parser('help')
 help_c.add_argument('command', nargs="?", default=None)
 
 
-if __name__ == '__main__':
-    # Help command emulation
-    if len(sys.argv) < 2:
-        parser.parse_args(['--help'])
-    args = parser.parse_args()
-    if args.sub == "help":
-        if not args.command:
-            parser.parse_args(['--help'])
-        else:
-            parser.parse_args([args.command, '--help'])
-    libvirt.virEventRegisterDefaultImpl()
-    try:
-        conn = libvirt.open(args.uri)
-    except libvirt.libvirtError:
-        sys.exit(1)
+# Run parsed command on connection in global conn
+def run(args):
+    global attrs, stream, run_console
 
 # Autostart section
     if args.sub == 'autostart':
@@ -768,7 +3851,6 @@ if __name__ == '__main__':
         if args.ip + args.storage + args.volumes + args.net + args.info >= 2:
             print('Please specify only one option at a time')
             sys.exit(1)
-        vsorted = [conn.lookupByID(i).name() for i in conn.listDomainsID()]
         if args.net:
             print('{0:<30}{1:<15}'.format('Interfaces', 'Status'))
             for i in conn.listInterfaces():
@@ -778,7 +3860,7 @@ if __name__ == '__main__':
             sys.exit(0)
         if args.info:
             hyper_info = conn.getInfo()
-            used_mem = sum([conn.lookupByName(i).info()[2] for i in vsorted])
+            used_mem = sum([d[4] for d in domain_stats() if d[1]])
             print('{0:<30}{1:<15}'.format('Hostname:', conn.getHostname()))
             print('{0:<30}{1:<15}'.format('CPU count:', hyper_info[2]))
             print('{0:<30}{1:<15}'.format('CPU MHz:', hyper_info[3]))
@@ -791,128 +3873,119 @@ if __name__ == '__main__':
         if not args.ip:
             lsvirt(args.storage, args.volumes)
             sys.exit(0)
-        if args.uri == 'qemu:///system':
-            print('{0:<30}{1:<15}'.format('Name', 'IP'))
-            for i in sorted(vsorted):
-                ip = Net(conn).ip(i)
-                print('{0:<30}{1:<15}'.format(i, str(ip)))
-        else:
-            print('Not available for remote connections')
+        vsorted = [d.name() for d in conn.listAllDomains(
+                libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)]
+        print('{0:<30}{1:<20}{2:<15}'.format('Name', 'MAC', 'IP'))
+        # Rows are printed in order addresses are resolved
+        asyncio.run(Net(conn).ips(sorted(vsorted), lambda name, mac, ip:
+                print('{0:<30}{1:<20}{2:<15}'.format(name, mac, str(ip)))))
 
 # Import and Create section
-    if args.sub == 'import':
-        if not args.xml and not args.image:
-            print('Either -xml or -i should be specified')
-            sys.exit(1)
-        mem = argcheck(args.mem)
-        if not args.mac and not args.xml:
-            mac = randomMAC()
-        elif not is_mac_addr(args.mac):
-            print('Incorrect mac address: {0}'.format(args.mac))
-            sys.exit(1)
-        else:
-            mac = args.mac
-        if args.xml and not args.image:
-            upload = False
-            template = xml2tmpl(args.xml.read(), args.name, mac=mac)
+    if args.sub in ('import', 'create'):
+        vms = bulk_args(args, {'import': box_add, 'create': box_create}[args.sub])
+        func = {'import': import_vm, 'create': create_vm}[args.sub]
+        if len(vms) == 1:
+            func(vms[0])
         else:
-            # LXC
-            if uri_lxc(args.uri):
-                upload = False
-                if not os.path.isdir(args.image):
-                    if not args.xml:
-                        print('No image and xml specified')
-                        sys.exit(1)
-                elif not args.xml:
-                    template = prepare_tmpl(args.name, mac, args.cpus, mem,
-                                            args.image, '', '', args.net, 'lxc')
-                else:
-                    template = xml2tmpl(args.xml.read(), args.name, args.image,
-                                        'format', 'mount', mac)
-            else:   # QEMU
-                if not os.path.isfile(args.image):
-                    print('{0} not found'.format(args.image))
-                    sys.exit(1)
-                format = find_image_format(args.image)
-                imgsize = os.path.getsize(args.image)
-                upload = True
-                image = Disk(conn, args.pool).create_vol(args.name, imgsize, format)
-                if is_lvm(args.pool):
-                    dtype = 'block'
-                else:
-                    dtype = 'file'
-                if args.xml:
-                    template = xml2tmpl(args.xml.read(), args.name, image, format, dtype, mac)
-                elif not args.xml:
-                    template = prepare_tmpl(args.name, mac, args.cpus, mem, image,
-                                            format, dtype, args.net, 'kvm')
-        try:
-            conn.defineXML(template)
-            print('{0} imported'.format(args.name))
-        except libvirt.libvirtError:
-            sys.exit(1)
-        if upload:
-            ret = Disk(conn, args.pool).upload_vol(args.name, args.image)
-            if not ret:
-                print('Upload failed. Exiting')
+            results = provision(func, vms, args.jobs, args.pool_jobs)
+            print('{0:<30}{1:<10}{2:<10}{3}'.format('Name', 'Result', 'Time', 'Message'))
+            for name, ok, took, msg in results:
+                print('{0:<30}{1:<10}{2:<10}{3}'.format(name, 'ok' if ok else 'failed',
+                        '{0:.1f}s'.format(took), msg))
+            if not all(r[1] for r in results):
                 sys.exit(1)
 
-# Create section
-    if args.sub == 'create':
-        mem = argcheck(args.mem)
-        if not args.mac:
-            mac = randomMAC()
-        elif not is_mac_addr(args.mac):
-            print('Incorrect mac address: {0}'.format(args.mac))
+# Template section
+    if args.sub == 'template':
+        if not os.path.isfile(args.image):
+            print('{0} not found'.format(args.image))
             sys.exit(1)
-        else:
-            mac = args.mac
-        format = args.dformat
-        imgsize = argcheck(args.size) * 1024
-        args.image = args.name
         if is_lvm(args.pool):
-            dtype = 'block'
-        else:
-            dtype = 'file'
-        image = Disk(conn, args.pool).create_vol(args.name, imgsize, format)
-        template = prepare_tmpl(args.name, mac, args.cpus, mem, image, format,
-            dtype, args.net)
-        try:
-            conn.defineXML(template)
-            print('{0} created'.format(args.name))
-        except libvirt.libvirtError:
+            print('Templates are supported only in directory pools')
+            sys.exit(1)
+        chunk = argcheck(args.chunk) * 1024
+        info = probe_image(args.image)
+        if info['backing'] is not None:
+            print('{0} is overlay of {1}, register it flattened'.format(
+                    args.image, info['backing'] or 'parent image'))
+            sys.exit(1)
+        Disk(conn, args.pool).create_image_vol(args.name, info)
+        if not Disk(conn, args.pool, chunk).upload_vol(args.name, args.image,
+                sparse=info['sparse'], size=info['apparent'],
+                algo=digest_algo(args.hash)):
+            print('Upload failed. Exiting')
             sys.exit(1)
+        # Let libvirt read virtual size of uploaded image for overlays
+        conn.storagePoolLookupByName(args.pool).refresh(0)
+        print('Template {0} registered in pool {1}'.format(args.name, args.pool))
+
+# Cache section
+    if args.sub == 'cache':
+        cache = Cache(conn, args.pool)
+        if args.action == 'ls':
+            print('{0:<55}{1:<10}{2:<20}'.format('Volume', 'Size', 'Last used'))
+            for v, size, used in reversed(cache.volumes()):
+                if used:
+                    used = time.strftime('%Y-%m-%d %H:%M', time.localtime(used))
+                else:
+                    used = 'unknown'
+                print('{0:<55}{1:<10}{2:<20}'.format(v.name(), convert_bytes(size), used))
+        else:
+            max_size = max_age = None
+            if args.size:
+                max_size = argcheck(args.size) * 1024
+            if args.days is not None:
+                max_age = args.days * 86400
+            if max_size is None and max_age is None:
+                max_size = 0
+            for v in cache.prune(max_size, max_age):
+                print('Cached volume {0} removed'.format(v))
 
 # Up section
     if args.sub == 'up':
-        try:
-            dom = conn.lookupByName(args.name)
-            s = dom.create()
-            if s == 0:
-                print('{0} started'.format(args.name))
-        except libvirt.libvirtError:
-            sys.exit(1)
+        names = [n for pattern in args.names for n in expand_names(pattern)]
+        for name in names:
+            try:
+                dom = state(conn).domain(name)
+                s = dom.create()
+                if s == 0:
+                    print('{0} started'.format(name))
+            except libvirt.libvirtError:
+                sys.exit(1)
+            state(conn).drop('domain', name)
+        if args.wait or args.wait_for:
+            print('{0:<30}{1:<15}'.format('Name', 'IP'))
+            # Rows are printed in order machines get ready
+            if not Waiter(conn, args.wait_for or 'ip', args.timeout).run(names,
+                    lambda name, ip: print('{0:<30}{1:<15}'.format(name, str(ip)))):
+                sys.exit(1)
 
 # Down section
     if args.sub == 'down':
         try:
-            dom = conn.lookupByName(args.name)
+            dom = state(conn).domain(args.name)
             s = dom.destroy()
             if s == 0:
                 print('{0} powered off'.format(args.name))
         except libvirt.libvirtError:
             sys.exit(1)
+        state(conn).drop('domain', args.name)
 
 # Rm section
     if args.sub == 'rm':
-        pool = get_stor(args.name)
-        vol = get_stor(args.name, 0)
+        stor = []
+        if args.full:
+            stor = get_stor(args.name)
         try:
-            conn.lookupByName(args.name).undefine()
+            dom = state(conn).domain(args.name)
+            xmldesc = state(conn).domain_xml(args.name)
+            dom.undefine()
             print('{0} removed'.format(args.name))
         except libvirt.libvirtError:
             sys.exit(1)
-        if args.full and vol:
+        state(conn).drop('domain', args.name)
+        release_ips(xmldesc)
+        for pool, vol in stor:
             Disk(conn, pool).delete_vol(vol)
             print('Volume {0} removed'.format(vol))
 
@@ -948,6 +4021,7 @@ if __name__ == '__main__':
         if not args.xml and not args.image:
             print('Nothing to export')
             sys.exit(1)
+        chunk = argcheck(args.chunk) * 1024
         if args.xml:
             try:
                 print(conn.lookupByName(args.name).XMLDesc(0))
@@ -955,18 +4029,35 @@ if __name__ == '__main__':
                 sys.exit(1)
         if not args.image:
             sys.exit(0)
+        since = None
+        if args.since:
+            since = BlockMap.load(args.since)
+            if not since:
+                print('Block map of {0} not found, export it with --blockmap'.format(
+                        args.since))
+                sys.exit(1)
+            if args.resume:
+                print('Incremental export can not be resumed')
+                sys.exit(1)
         try:
-            f = open(args.image, 'w')
+            # Partially downloaded image is kept for resume
+            if args.resume:
+                f = open(args.image, 'ab')
+            elif since:
+                f = open(args.image, 'wb')
+            else:
+                f = open_image(args.image, 'wb')
             f.close()
         except IOError as e:
             print(e)
             sys.exit(1)
-        pool = get_stor(args.name)
-        vol = get_stor(args.name, 0)
-        if not vol:
+        stor = get_stor(args.name)
+        if not stor:
             print('Volume attached to {0} not found'.format(args.name))
             sys.exit(1)
-        if Disk(conn, pool).download_vol(vol, args.image):
+        pool, vol = stor[0]
+        if Disk(conn, pool, chunk).download_vol(vol, args.image, resume=args.resume,
+                algo=digest_algo(args.hash), blockmap=args.blockmap, since=since):
             sys.exit(0)
         else:
             sys.exit(1)
@@ -1005,3 +4096,27 @@ if __name__ == '__main__':
         else:
             Disk(conn, args.pool).delete_vol(args.volume)
             print('Volume {0} removed'.format(args.volume))
+
+
+if __name__ == '__main__':
+    # Help command emulation
+    if len(sys.argv) < 2:
+        parser.parse_args(['--help'])
+    args = parser.parse_args()
+    if args.sub == "help":
+        if not args.command:
+            parser.parse_args(['--help'])
+        else:
+            parser.parse_args([args.command, '--help'])
+    libvirt.virEventRegisterDefaultImpl()
+    if args.sub == 'daemon':
+        serve()
+        sys.exit(0)
+    try:
+        conn = libvirt.open(args.uri)
+    except libvirt.libvirtError:
+        sys.exit(1)
+    try:
+        run(args)
+    finally:
+        print_stats(args)